@@ -1,45 +1,93 @@
 from flask import Flask
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-import logging
-from logging.handlers import SMTPHandler
-from logging.handlers import RotatingFileHandler
+from app.database import RoutingSQLAlchemy
 import os
+import weakref
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
-login.login_view = 'login'
-
-if not app.debug:
-    if app.config['MAIL_SERVER']:
-        auth = None
-        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        secure = None
-        if app.config['MAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-            toaddrs=app.config['ADMINS'], subject='Terminal News Failure',
-            credentials=auth, secure=secure)
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/terminal_news.log', maxBytes=10240,
-                                       backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Terminal News startup')
-
-from app import routes, models, errors
\ No newline at end of file
+DEFAULTS = {
+    'ARTICLES_PER_PAGE': 25,
+    'PLAYERS_PER_PAGE': 25,
+    'INSTRUMENTATION': False,
+    'INSTRUMENTATION_WINDOW': 1000,
+    'INSTRUMENTATION_SLOW_QUERIES': 5,
+    'SLOW_REQUEST_MS': 500,
+    'LAST_SEEN_RESOLUTION': 60,
+    'LAST_SEEN_FLUSH_INTERVAL': 30,
+    'LAST_SEEN_FLUSH_THRESHOLD': 100,
+    'USER_CACHE_SIZE': 1024,
+    'USER_CACHE_TTL': 300,
+    'USER_CACHE_CHECK_INTERVAL': 1,
+    'STREAM_QUEUE_SIZE': 100,
+    'STREAM_REPLAY_SIZE': 500,
+    'STREAM_KEEPALIVE': 15,
+    'FRAGMENT_CACHE_SIZE': 4096,
+    'LOG_QUEUE_SIZE': 10000,
+    'LOG_MAX_BYTES': 10 * 1024 * 1024,
+    'MAIL_DIGEST_INTERVAL': 300,
+    'MAIL_DIGEST_MAX_ENTRIES': 50,
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:260000',
+    'PASSWORD_SALT_LENGTH': 16,
+    'PASSWORD_HASH_WORKERS': os.cpu_count() or 1,
+    'PASSWORD_HASH_MAX_PENDING': 32,
+    'PASSWORD_HASH_QUEUE_TIMEOUT': 2,
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_REPLICA_BIND': 'replica',
+    'DB_REPLICA_PIN_SECONDS': 5,
+}
+
+db = RoutingSQLAlchemy()
+migrate = Migrate()
+login = LoginManager()
+login.login_view = 'main.login'
+
+_apps = weakref.WeakSet()
+
+
+def create_app(config_class=Config):
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    login.init_app(app)
+
+    from app import models, search, page_cache, feed_stream, instrumentation, log_pipeline
+    from app import catalog, last_seen, team_graph, user_cache, passwords
+    for state in (user_cache, team_graph, last_seen, feed_stream, page_cache, passwords):
+        state.init_app(app)
+    app.teardown_request(models.clear_request_cache_on_teardown)
+    app.cli.add_command(search.rebuild_search)
+    app.cli.add_command(catalog.catalog_cli)
+
+    from app.errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+
+    from app.routes import bp as main_bp
+    app.register_blueprint(main_bp)
+
+    if app.config['INSTRUMENTATION']:
+        instrumentation.init_app(app)
+    if not app.debug and not app.testing:
+        log_pipeline.init_app(app)
+
+    _apps.add(app)
+    return app
+
+
+def _dispose_engines_after_fork():
+    # Pooled connections inherited from the parent must not be shared with
+    # it; drop them without closing so the parent's sockets stay intact.
+    for app in list(_apps):
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            db.get_engine(app, bind).dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
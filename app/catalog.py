@@ -0,0 +1,262 @@
+import csv
+import itertools
+import json
+import os
+import time
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Integer, bindparam, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import Affiliations, CacheVersion, Character, Game, System, User, Weapon
+
+CATALOGS = {
+    'weapons': Weapon,
+    'affiliations': Affiliations,
+    'systems': System,
+    'games': Game,
+}
+
+# Foreign keys travel as the referenced row's unique name so catalogs can
+# move between databases whose ids differ.
+REFERENCES = {
+    Game: {'system': (System.__table__.c.name, 'system_id'),
+           'game_master': (User.__table__.c.username, 'user_id')},
+}
+
+
+# Columns maintained by the application rather than loaded from catalogs.
+DERIVED = {
+    Game: {'player_count', 'seats_left'},
+    Weapon: {'damage_dice', 'damage_sides', 'damage_bonus', 'property_data'},
+}
+
+
+def _parse_weapon(row):
+    row.update(Weapon.parsed_columns(row.get('damage'), row.get('properties')))
+
+
+def _weapons_changed(conn, batch):
+    weapon_ids = select(Weapon.__table__.c.id).where(
+        Weapon.__table__.c.name.in_([row['name'] for row in batch]))
+    if Character.recount_totals(conn, weapon_ids):
+        CacheVersion.bump(conn, 'roster')
+
+
+def _games_changed(conn, batch):
+    game = Game.__table__
+    conn.execute(game.update().where(game.c.name.in_([row['name'] for row in batch])).values(
+        seats_left=game.c.player_cap - game.c.player_count))
+
+
+# Derived columns computed from each incoming row, and work to redo once a
+# batch has been written.
+PREPARE = {Weapon: _parse_weapon}
+AFTER_BATCH = {Weapon: _weapons_changed, Game: _games_changed}
+
+
+def catalog_columns(model):
+    skip = {'id'} | DERIVED.get(model, set()) | \
+        {fk for _, fk in REFERENCES.get(model, {}).values()}
+    return [c for c in model.__table__.columns if c.name not in skip]
+
+
+def stored_names(model):
+    names = [c.name for c in catalog_columns(model)] + \
+        [fk for _, fk in REFERENCES.get(model, {}).values()]
+    if model in PREPARE:
+        names += sorted(DERIVED[model])
+    return names
+
+
+def field_names(model):
+    return [c.name for c in catalog_columns(model)] + list(REFERENCES.get(model, {}))
+
+
+def detect_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError(f'Unknown catalog format {fmt!r}; use jsonl or csv.')
+    return fmt
+
+
+def read_rows(fp, fmt, model):
+    integers = {c.name for c in catalog_columns(model) if isinstance(c.type, Integer)}
+    if fmt == 'csv':
+        for row in csv.DictReader(fp):
+            yield {key: None if value == '' else int(value) if key in integers else value
+                   for key, value in row.items()}
+    else:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(fp, fmt, model, rows):
+    if fmt == 'csv':
+        writer = csv.DictWriter(fp, field_names(model), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            fp.write(json.dumps(row) + '\n')
+
+
+def _resolve_references(conn, model, batch):
+    for field, (name_column, fk) in REFERENCES.get(model, {}).items():
+        names = {row[field] for row in batch if row.get(field) is not None}
+        ids = dict(conn.execute(select(name_column, name_column.table.c.id).where(
+            name_column.in_(names))).all()) if names else {}
+        for row in batch:
+            name = row.pop(field, None)
+            if name is not None and name not in ids:
+                raise ValueError(f'{model.__name__} {row.get("name")!r}: '
+                                 f'unknown {field} {name!r}')
+            row[fk] = ids.get(name)
+
+
+def _upsert(conn, model, batch, on_conflict):
+    table = model.__table__
+    names = stored_names(model)
+    if any(not row.get('name') for row in batch):
+        raise ValueError(f'Every {table.name} row needs a name.')
+    rows = [{name: row.get(name) for name in names} for row in batch]
+    dialect = conn.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        updates = {name: insert.excluded[name] for name in names if name != 'name'}
+        if on_conflict == 'skip' or not updates:
+            stmt = insert.on_conflict_do_nothing(index_elements=['name'])
+        else:
+            stmt = insert.on_conflict_do_update(index_elements=['name'], set_=updates)
+        conn.execute(stmt, rows)
+        return
+    existing = set(conn.execute(select(table.c.name).where(
+        table.c.name.in_([row['name'] for row in rows]))).scalars())
+    new = [row for row in rows if row['name'] not in existing]
+    if new:
+        conn.execute(table.insert(), new)
+    old = [row for row in rows if row['name'] in existing]
+    if old and on_conflict == 'update' and len(names) > 1:
+        conn.execute(table.update().where(table.c.name == bindparam('b_name')).values(
+            {name: bindparam('b_' + name) for name in names if name != 'name'}),
+            [{'b_' + name: value for name, value in row.items()} for row in old])
+
+
+def import_rows(model, rows, batch_size=1000, on_conflict='update', skip=0,
+                progress=None):
+    """Upsert rows on the unique name column, one transaction per batch.
+
+    `progress(done, elapsed)` is called after every committed batch with the
+    total number of rows consumed so far, which can be passed back as
+    `skip` to resume an interrupted import.
+    """
+    rows = itertools.islice(rows, skip, None)
+    done = skip
+    start = time.perf_counter()
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        with db.engine.begin() as conn:
+            _resolve_references(conn, model, batch)
+            if model in PREPARE:
+                for row in batch:
+                    PREPARE[model](row)
+            _upsert(conn, model, batch, on_conflict)
+            if model in AFTER_BATCH:
+                AFTER_BATCH[model](conn, batch)
+        done += len(batch)
+        if progress is not None:
+            progress(done, time.perf_counter() - start)
+    return done
+
+
+def export_rows(model, batch_size=1000):
+    table = model.__table__
+    query = select(*catalog_columns(model)).select_from(table)
+    for field, (name_column, fk) in REFERENCES.get(model, {}).items():
+        target = name_column.table.alias(field)
+        query = query.add_columns(target.c[name_column.name].label(field)).outerjoin(
+            target, table.c[fk] == target.c.id)
+    query = query.order_by(table.c.id)
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        for partition in result.mappings().partitions(batch_size):
+            for row in partition:
+                yield dict(row)
+
+
+def _rate(done, elapsed):
+    return done / elapsed if elapsed else 0.0
+
+
+catalog_cli = AppGroup('catalog', help='Bulk import and export of game reference data.')
+
+catalog_names = click.Choice(sorted(CATALOGS))
+
+
+@catalog_cli.command('import')
+@click.argument('catalog', type=catalog_names)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']))
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--on-conflict', type=click.Choice(['update', 'skip']), default='update',
+              show_default=True)
+@click.option('--resume/--no-resume', default=False,
+              help='Continue after the last batch recorded in PATH.progress.')
+def import_catalog(catalog, path, fmt, batch_size, on_conflict, resume):
+    """Stream a JSONL or CSV catalog into the database."""
+    model = CATALOGS[catalog]
+    marker = path + '.progress'
+    skip = 0
+    if resume and os.path.exists(marker):
+        with open(marker) as fp:
+            skip = int(fp.read() or 0)
+        click.echo(f'Resuming after {skip} rows.', err=True)
+
+    def progress(done, elapsed):
+        with open(marker + '.tmp', 'w') as fp:
+            fp.write(str(done))
+        os.replace(marker + '.tmp', marker)
+        click.echo(f'{done} rows, {_rate(done - skip, elapsed):.0f} rows/s', err=True)
+
+    start = time.perf_counter()
+    try:
+        with open(path, newline='', encoding='utf-8') as fp:
+            done = import_rows(model, read_rows(fp, detect_format(path, fmt), model),
+                               batch_size, on_conflict, skip, progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if os.path.exists(marker):
+        os.remove(marker)
+    elapsed = time.perf_counter() - start
+    click.echo(f'Imported {done - skip} {catalog} in {elapsed:.2f}s '
+               f'({_rate(done - skip, elapsed):.0f} rows/s).')
+
+
+@catalog_cli.command('export')
+@click.argument('catalog', type=catalog_names)
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']))
+@click.option('--batch-size', default=1000, show_default=True)
+def export_catalog(catalog, path, fmt, batch_size):
+    """Stream a catalog out of the database as JSONL or CSV."""
+    model = CATALOGS[catalog]
+    try:
+        fmt = detect_format(path, fmt)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    start = time.perf_counter()
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for count, row in enumerate(rows, 1):
+            yield row
+
+    with open(path, 'w', newline='', encoding='utf-8') as fp:
+        write_rows(fp, fmt, model, counted(export_rows(model, batch_size)))
+    elapsed = time.perf_counter() - start
+    click.echo(f'Exported {count} {catalog} in {elapsed:.2f}s '
+               f'({_rate(count, elapsed):.0f} rows/s).')
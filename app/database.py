@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import deque
+from flask import current_app, g, has_request_context, request, session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from app.instrumentation import percentile
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class PoolMetrics(object):
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.wait_ms = deque(maxlen=window)
+        self.checkout_ms = deque(maxlen=window)
+        self.checkouts = 0
+        self.timeouts = 0
+
+    def waited(self, ms):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_ms.append(ms)
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def held(self, ms):
+        with self.lock:
+            self.checkout_ms.append(ms)
+
+    def summary(self, pool):
+        with self.lock:
+            result = {'checkouts': self.checkouts, 'timeouts': self.timeouts}
+            for key in ('wait_ms', 'checkout_ms'):
+                values = list(getattr(self, key))
+                result[key] = {f'p{pct}': percentile(values, pct) for pct in (50, 90, 99)}
+                result[key]['max'] = max(values) if values else 0.0
+        result.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+        return result
+
+
+class MeteredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            conn = super(MeteredQueuePool, self).connect()
+        except exc.TimeoutError:
+            self.metrics.timed_out()
+            raise
+        self.metrics.waited((time.perf_counter() - start) * 1000)
+        return conn
+
+    def recreate(self):
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def _checkout(dbapi_connection, record, proxy):
+    record.info['checked_out'] = time.perf_counter()
+
+
+def _make_checkin(engine):
+    def checkin(dbapi_connection, record):
+        start = record.info.pop('checked_out', None)
+        if start is not None:
+            engine.pool.metrics.held((time.perf_counter() - start) * 1000)
+    return checkin
+
+
+def use_primary():
+    # Reads in the rest of this request go to the primary, e.g. right
+    # before a read that must see a write made by another process.
+    g.db_bind = None
+
+
+def wants_replica():
+    return has_request_context() and g.get('db_bind') is not None
+
+
+def choose_bind():
+    bind = current_app.config['DB_REPLICA_BIND']
+    g.db_bind = None
+    if bind in (current_app.config.get('SQLALCHEMY_BINDS') or ()) and \
+            request.method in READ_METHODS and \
+            cookie_session.get('_db_primary_until', 0) < time.time():
+        g.db_bind = bind
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        bind_key = None
+        if mapper is not None:
+            bind_key = mapper.persist_selectable.info.get('bind_key')
+        if bind_key is None and not self._flushing and not isinstance(clause, UpdateBase) \
+                and not self.info.get('wrote') and wants_replica():
+            return self.db.get_engine(self.app, bind=g.db_bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_statement_written(orm_execute_state):
+    # Core INSERT/UPDATE/DELETE through session.execute() bypasses the flush.
+    if orm_execute_state.is_insert or orm_execute_state.is_update or \
+            orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _pin_primary(session):
+    # Replicas lag behind; keep this browser on the primary for a while
+    # so it reads its own writes after the redirect.
+    if session.info.pop('wrote', False) and has_request_context():
+        pin = current_app.config['DB_REPLICA_PIN_SECONDS']
+        if pin:
+            cookie_session['_db_primary_until'] = time.time() + pin
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget_writes(session, previous_transaction):
+    session.info.pop('wrote', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+        app.before_request(choose_bind)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        options.setdefault('pool_pre_ping', app.config['DB_POOL_PRE_PING'])
+        if app.config['DB_POOL_RECYCLE'] is not None:
+            options.setdefault('pool_recycle', app.config['DB_POOL_RECYCLE'])
+        in_memory = sa_url.drivername.startswith('sqlite') and \
+            sa_url.database in (None, '', ':memory:')
+        if not in_memory and 'poolclass' not in options:
+            options['poolclass'] = MeteredQueuePool
+            options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+            if sa_url.drivername.startswith('sqlite'):
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+        return super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if isinstance(engine.pool, MeteredQueuePool):
+            event.listen(engine, 'checkout', _checkout)
+            event.listen(engine, 'checkin', _make_checkin(engine))
+        return engine
+
+    def pool_stats(self, app=None):
+        app = self.get_app(app)
+        stats = {}
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            pool = self.get_engine(app, bind).pool
+            if isinstance(pool, MeteredQueuePool):
+                stats[bind or 'default'] = pool.metrics.summary(pool)
+        return stats
@@ -1,11 +1,19 @@
 from flask import render_template
-from app import app, db
+from flask import Blueprint
+from app import db
+from app.passwords import PasswordPoolBusy
 
-@app.errorhandler(404)
+bp = Blueprint('errors', __name__)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
-    return render_template('500.html'), 500
\ No newline at end of file
+    return render_template('500.html'), 500
+
+@bp.app_errorhandler(PasswordPoolBusy)
+def busy_error(error):
+    return render_template('503.html'), 503
\ No newline at end of file
@@ -0,0 +1,140 @@
+import json
+import queue
+import threading
+from collections import deque
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.local import LocalProxy
+from app.models import Article
+
+
+class Subscriber(object):
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class FeedHub(object):
+    def __init__(self, queue_size=100, replay_size=500):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.recent = deque(maxlen=replay_size)
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, item):
+        with self.lock:
+            self.recent.append(item)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(item)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def replay(self, last_id):
+        with self.lock:
+            recent = list(self.recent)
+        if not recent or min(item['id'] for item in recent) > last_id + 1:
+            return None
+        return [item for item in recent if item['id'] > last_id]
+
+
+def init_app(app):
+    app.extensions['feed_hub'] = FeedHub(app.config['STREAM_QUEUE_SIZE'],
+                                         app.config['STREAM_REPLAY_SIZE'])
+
+
+feed_hub = LocalProxy(lambda: current_app.extensions['feed_hub'])
+
+
+def article_event(article):
+    return {
+        'id': article.id,
+        'headline': article.headline,
+        'body': article.body,
+        'author': article.author.username if article.author else None,
+        'timestamp': article.timestamp.isoformat() + 'Z',
+    }
+
+
+def format_event(item):
+    return f"id: {item['id']}\nevent: article\ndata: {json.dumps(item)}\n\n"
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_new_articles(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Article):
+            session.info.setdefault('new_articles', []).append(article_event(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_new_articles(session):
+    for item in sorted(session.info.pop('new_articles', ()), key=lambda item: item['id']):
+        feed_hub.publish(item)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_new_articles(session, previous_transaction):
+    session.info.pop('new_articles', None)
+
+
+def event_stream(last_id, keepalive):
+    # The generator outlives the request context, so hold on to this app's hub.
+    hub = feed_hub._get_current_object()
+    subscriber = hub.subscribe()
+    missed = []
+    if last_id is not None:
+        missed = hub.replay(last_id)
+        if missed is None:
+            missed = [article_event(article) for article in Article.query.filter(
+                Article.id > last_id).order_by(Article.id).limit(hub.recent.maxlen)]
+
+    def events():
+        # Concurrent commits can publish ids out of order, so remember which
+        # ids went out instead of only the highest one.
+        sent, order = set(), deque()
+
+        def fresh(item):
+            if item['id'] in sent:
+                return False
+            sent.add(item['id'])
+            order.append(item['id'])
+            if len(order) > hub.recent.maxlen:
+                sent.discard(order.popleft())
+            return True
+
+        try:
+            yield 'retry: 3000\n\n'
+            for item in missed:
+                if fresh(item):
+                    yield format_event(item)
+            while not subscriber.dropped:
+                item = subscriber.get(keepalive)
+                if item is None:
+                    yield ': keepalive\n\n'
+                elif (last_id is None or item['id'] > last_id) and fresh(item) \
+                        and not subscriber.dropped:
+                    yield format_event(item)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return events()
@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, IntegerField
-from wtforms.validators import ValidationError, DataRequired, Email, EqualTo, Length
-from app.models import User, Character
+from wtforms.validators import DataRequired, Email, EqualTo, Length
+from app.models import User, Character, taken_values
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -9,26 +9,39 @@ class LoginForm(FlaskForm):
     remember_me = BooleanField('Remember Me')
     submit = SubmitField('Sign In')
 
-class UserRegistrationForm(FlaskForm):
-    
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).one_or_none()
-        if user is not None:
-            raise ValidationError('Please use a different username.')
+class UniqueFieldsForm(FlaskForm):
+    unique_messages = {
+        'username': 'Please use a different username.',
+        'email': 'Please use a different email address.',
+        'name': 'Please use a different character name.',
+        'char_name': 'Please use a different character name.',
+    }
+
+    def unique_columns(self):
+        return {}
+
+    def check_unique(self):
+        fields = {name: getattr(self, name) for name in self.unique_columns()}
+        taken = taken_values({name: (column, fields[name].data)
+                              for name, column in self.unique_columns().items()
+                              if fields[name].data and not fields[name].errors})
+        for name in taken:
+            fields[name].errors.append(self.unique_messages[name])
+        return not taken
+
+    def validate(self, extra_validators=None):
+        valid = super(UniqueFieldsForm, self).validate(extra_validators)
+        unique = self.check_unique()
+        return valid and unique
 
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).one_or_none()
-        if user is not None:
-            raise ValidationError('Please use a different email address.')
+class UserRegistrationForm(UniqueFieldsForm):
 
-    def validate_character(self, name):
-        char = Character.query.filter_by(name=name.data).one_or_none()
-        if char is not None:
-            raise ValidationError('Please use a different character name.')
+    def unique_columns(self):
+        return {'username': User.username, 'email': User.email, 'name': Character.name}
         
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('Email', validators=[DataRequired(), Email()])
-    name = StringField('Character Name', validators=[DataRequired(), validate_character])   
+    name = StringField('Character Name', validators=[DataRequired()])   
     password = PasswordField('Password', validators=[DataRequired()])
     password2 = PasswordField('Repeat Password', validators=[DataRequired(), EqualTo('password')])
 
@@ -36,7 +49,7 @@ class UserRegistrationForm(FlaskForm):
 
 
 
-class EditProfileForm(FlaskForm):
+class EditProfileForm(UniqueFieldsForm):
 
     def __init__(
         self, original_username,
@@ -50,17 +63,13 @@ class EditProfileForm(FlaskForm):
         self.original_char_level = original_char_level
         self.original_char_speed = original_char_speed
     
-    def validate_username(self, username):
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
-                raise ValidationError('Please use a different username.')   
-   
-    def validate_char_name(self, char_name):
-        if char_name.data != self.original_char_name:
-            char = Character.query.filter_by(name=self.char_name.data).first()
-            if char is not None:
-                raise ValidationError('Please use a different character name.')   
+    def unique_columns(self):
+        columns = {}
+        if self.username.data != self.original_username:
+            columns['username'] = User.username
+        if self.char_name.data != self.original_char_name:
+            columns['char_name'] = Character.name
+        return columns
 
     username = StringField('Username', validators=[DataRequired()])
     char_name = StringField('Character Name', validators=[DataRequired()])
@@ -0,0 +1,146 @@
+import heapq
+import threading
+import time
+from collections import deque
+from flask import current_app, g, has_request_context, request
+from flask import request_started, request_finished, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.local import LocalProxy
+
+_lock = threading.Lock()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+class RouteStats(object):
+    def __init__(self, window, slow_queries):
+        self.count = 0
+        self.samples = deque(maxlen=window)
+        self.slow_queries = []
+        self.max_slow_queries = slow_queries
+
+    def record(self, sample, queries):
+        self.count += 1
+        self.samples.append(sample)
+        for duration, statement in queries:
+            seen = [i for i, (_, s) in enumerate(self.slow_queries) if s == statement]
+            if seen:
+                if duration > self.slow_queries[seen[0]][0]:
+                    self.slow_queries[seen[0]] = (duration, statement)
+                    heapq.heapify(self.slow_queries)
+            elif len(self.slow_queries) < self.max_slow_queries:
+                heapq.heappush(self.slow_queries, (duration, statement))
+            elif duration > self.slow_queries[0][0]:
+                heapq.heapreplace(self.slow_queries, (duration, statement))
+
+    def summary(self):
+        result = {'count': self.count}
+        for key in ('duration_ms', 'sql_count', 'db_ms', 'render_ms'):
+            values = [sample[key] for sample in self.samples]
+            result[key] = {f'p{pct}': percentile(values, pct) for pct in (50, 90, 99)}
+        result['slowest_queries'] = [
+            {'ms': duration, 'statement': statement}
+            for duration, statement in sorted(self.slow_queries, reverse=True)]
+        return result
+
+
+def summary():
+    with _lock:
+        return {endpoint: route.summary() for endpoint, route in stats.items()}
+
+
+def reset():
+    with _lock:
+        stats.clear()
+
+
+def _current():
+    if has_request_context():
+        return g.get('instrumentation')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    current = _current()
+    if current is None or not conn.info.get('query_start'):
+        return
+    elapsed = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+    current['sql_count'] += 1
+    current['db_ms'] += elapsed
+    current['queries'].append((elapsed, statement))
+
+
+def _request_started(sender, **extra):
+    g.instrumentation = {'start': time.perf_counter(), 'sql_count': 0, 'db_ms': 0.0,
+                         'render_ms': 0.0, 'render_start': None, 'render_depth': 0,
+                         'queries': []}
+
+
+def _before_render_template(sender, template, context, **extra):
+    current = _current()
+    if current is not None:
+        if current['render_depth'] == 0:
+            current['render_start'] = time.perf_counter()
+        current['render_depth'] += 1
+
+
+def _template_rendered(sender, template, context, **extra):
+    current = _current()
+    if current is not None and current['render_depth'] > 0:
+        current['render_depth'] -= 1
+        if current['render_depth'] == 0:
+            current['render_ms'] += (time.perf_counter() - current['render_start']) * 1000
+
+
+def _request_finished(sender, response, **extra):
+    current = _current()
+    if current is None:
+        return
+    sample = {
+        'duration_ms': (time.perf_counter() - current['start']) * 1000,
+        'sql_count': current['sql_count'],
+        'db_ms': current['db_ms'],
+        'render_ms': current['render_ms'],
+    }
+    endpoint = request.endpoint or 'unmatched'
+    with _lock:
+        route = stats.get(endpoint)
+        if route is None:
+            route = stats[endpoint] = RouteStats(
+                current_app.config['INSTRUMENTATION_WINDOW'],
+                current_app.config['INSTRUMENTATION_SLOW_QUERIES'])
+        route.record(sample, current['queries'])
+    budget = current_app.config['SLOW_REQUEST_MS']
+    if budget and sample['duration_ms'] > budget:
+        current_app.logger.warning(
+            'Slow request %s %s: %.1f ms, %d queries (%.1f ms), render %.1f ms',
+            request.method, request.path, sample['duration_ms'], sample['sql_count'],
+            sample['db_ms'], sample['render_ms'])
+
+
+def init_app(app):
+    if 'instrumentation' in app.extensions:
+        return
+    app.extensions['instrumentation'] = {}
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    request_started.connect(_request_started, app)
+    request_finished.connect(_request_finished, app)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+
+# Route stats for the current app, keyed by endpoint.
+stats = LocalProxy(lambda: current_app.extensions['instrumentation'])
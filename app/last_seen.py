@@ -0,0 +1,98 @@
+import atexit
+import threading
+import time
+import weakref
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam, or_, update
+from werkzeug.local import LocalProxy
+from app import db
+from app.models import User
+
+
+class LastSeenBuffer(object):
+    def __init__(self, resolution=60, interval=30, threshold=100):
+        self.resolution = timedelta(seconds=resolution)
+        self.interval = interval
+        self.threshold = threshold
+        self.app = None
+        self.pending = {}
+        self.written = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            # user.last_seen may come from the identity cache, which the bulk
+            # UPDATE never refreshes, so prefer what this buffer last wrote.
+            seen = self.pending.get(user.id) or self.written.get(user.id) or user.last_seen
+            if seen is None or now - seen >= self.resolution:
+                self.pending[user.id] = now
+            # Check the interval on every touch, not just on new timestamps,
+            # so a quiet buffer still drains once the interval has passed.
+            due = bool(self.pending) and (len(self.pending) >= self.threshold or
+                                          time.monotonic() - self.last_flush >= self.interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.last_flush = time.monotonic()
+            if not pending:
+                return 0
+            try:
+                self._write(pending)
+            except Exception:
+                with self.lock:
+                    for user_id, seen in pending.items():
+                        if self.pending.get(user_id, seen) <= seen:
+                            self.pending[user_id] = seen
+                raise
+            self._remember(pending)
+            return len(pending)
+
+    def _remember(self, pending):
+        horizon = datetime.utcnow() - self.resolution
+        with self.lock:
+            for user_id, seen in pending.items():
+                self.written[user_id] = max(seen, self.written.get(user_id, seen))
+            self.written = {user_id: seen for user_id, seen in self.written.items()
+                            if seen > horizon}
+
+    def _write(self, pending):
+        table = User.__table__
+        stmt = update(table).where(table.c.id == bindparam('user_id')).where(
+            or_(table.c.last_seen == None, table.c.last_seen < bindparam('seen'))).values(
+            last_seen=bindparam('seen'))
+        with db.engine.begin() as conn:
+            conn.execute(stmt, [{'user_id': user_id, 'seen': seen}
+                                for user_id, seen in pending.items()])
+
+
+_buffers = weakref.WeakSet()
+
+
+def init_app(app):
+    app_buffer = LastSeenBuffer(app.config['LAST_SEEN_RESOLUTION'],
+                                app.config['LAST_SEEN_FLUSH_INTERVAL'],
+                                app.config['LAST_SEEN_FLUSH_THRESHOLD'])
+    app_buffer.app = app
+    app.extensions['last_seen'] = app_buffer
+    _buffers.add(app_buffer)
+
+
+buffer = LocalProxy(lambda: current_app.extensions['last_seen'])
+
+
+@atexit.register
+def _flush_on_exit():
+    for app_buffer in list(_buffers):
+        with app_buffer.app.app_context():
+            try:
+                app_buffer.flush()
+            except Exception:
+                app_buffer.app.logger.exception('Could not flush last_seen updates on shutdown')
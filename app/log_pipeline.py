@@ -0,0 +1,210 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.template = str(record.msg)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogListener(QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full of records when we stop; wait for room
+        # instead of losing the sentinel and leaving the thread running.
+        self.queue.put(self._sentinel)
+
+
+class DigestMailHandler(logging.Handler):
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+                 secure=None, interval=300, max_entries=50, timeout=10):
+        super(DigestMailHandler, self).__init__(logging.ERROR)
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.interval = interval
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.pending = OrderedDict()
+        self.suppressed = 0
+        self.sent = 0
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.sender = threading.Thread(target=self._run, name='mail-digest', daemon=True)
+        self.sender.start()
+
+    def emit(self, record):
+        key = (record.levelname, record.pathname, record.lineno,
+               getattr(record, 'template', record.msg))
+        self.acquire()
+        try:
+            if key in self.pending:
+                self.pending[key][1] += 1
+            elif len(self.pending) < self.max_entries:
+                self.pending[key] = [self.format(record), 1]
+            else:
+                self.suppressed += 1
+        finally:
+            self.release()
+
+    def _take(self):
+        self.acquire()
+        try:
+            pending, self.pending = self.pending, OrderedDict()
+            suppressed, self.suppressed = self.suppressed, 0
+        finally:
+            self.release()
+        return list(pending.values()), suppressed
+
+    def _run(self):
+        while not self.closing:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.send_digest()
+
+    def send_digest(self):
+        entries, suppressed = self._take()
+        if not entries:
+            return
+        parts = [f'[{count}x] {text}' if count > 1 else text for text, count in entries]
+        if suppressed:
+            parts.append(f'... and {suppressed} more errors not shown.')
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ', '.join(self.toaddrs)
+        msg['Subject'] = f'{self.subject} ({sum(count for _, count in entries) + suppressed} errors)'
+        msg.set_content('\n\n'.join(parts))
+        try:
+            with smtplib.SMTP(*self.mailhost, timeout=self.timeout) as smtp:
+                if self.secure is not None:
+                    smtp.starttls(*self.secure)
+                if self.credentials:
+                    smtp.login(*self.credentials)
+                smtp.send_message(msg)
+            self.sent += 1
+        except Exception:
+            self.handleError(logging.makeLogRecord({'msg': msg['Subject']}))
+
+    def flush(self):
+        self.wakeup.set()
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        self.sender.join(self.timeout + 1)
+        super(DigestMailHandler, self).close()
+
+
+def attach_queue(logger, handlers, queue_size):
+    log_queue = queue.Queue(maxsize=queue_size)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    listener = LogListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def setup_logging(app):
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, DroppingQueueHandler):
+            app.logger.removeHandler(handler)
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = DigestMailHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Terminal News Failure',
+            credentials=auth, secure=secure,
+            interval=app.config['MAIL_DIGEST_INTERVAL'],
+            max_entries=app.config['MAIL_DIGEST_MAX_ENTRIES'])
+        mail_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        handlers.append(mail_handler)
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+    file_handler = RotatingFileHandler('logs/terminal_news.log',
+                                       maxBytes=app.config['LOG_MAX_BYTES'],
+                                       backupCount=10)
+    file_handler.setFormatter(JSONFormatter())
+    file_handler.setLevel(logging.INFO)
+    handlers.append(file_handler)
+
+    listener = attach_queue(app.logger, handlers, app.config['LOG_QUEUE_SIZE'])
+
+    @atexit.register
+    def stop_logging():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+    app.logger.setLevel(logging.INFO)
+    return listener
+
+
+def init_app(app):
+    # Listener and mail threads do not survive a fork, so the pipeline is
+    # started lazily by the first request each worker process serves.
+    lock = threading.Lock()
+    started = {'pid': None}
+
+    @app.before_request
+    def start_logging():
+        if started['pid'] == os.getpid():
+            return
+        with lock:
+            if started['pid'] != os.getpid():
+                setup_logging(app)
+                started['pid'] = os.getpid()
+                app.logger.info('Terminal News startup')
@@ -1,18 +1,49 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from app import db
 from flask_login import UserMixin
 from app import login
 from hashlib import md5
+from flask import g, has_app_context
+from collections import namedtuple
+from itertools import chain
+from sqlalchemy import event, exists, func, inspect, literal, or_, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached, object_session
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.util import identity_key
+from app.user_cache import user_cache
+from app.team_graph import team_graph
+from app.passwords import hasher
+from app.rules import parse_damage, parse_properties
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+TeamView = namedtuple('TeamView', ['confirmed', 'outgoing', 'incoming'])
+
+def request_cache(name):
+    if not has_app_context():
+        return {}
+    return g.setdefault('model_cache', {}).setdefault(name, {})
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def clear_request_cache(session, *args):
+    if has_app_context():
+        g.pop('model_cache', None)
+
+def clear_request_cache_on_teardown(exc):
+    g.pop('model_cache', None)
 
 games_and_players = db.Table('games_and_players',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('game_id', db.Integer, db.ForeignKey('game.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('game_id', db.Integer, db.ForeignKey('game.id'), primary_key=True),
+    db.Index('ix_games_and_players_game_id', 'game_id', 'user_id')
 )
 
 teammates = db.Table('teammates',
-    db.Column('team_member_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('teammate_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('team_member_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('teammate_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_teammates_teammate_id', 'teammate_id', 'team_member_id')
 )
 
 class User(UserMixin, db.Model):
@@ -26,9 +57,7 @@ class User(UserMixin, db.Model):
     gm_status = db.Column(db.Integer, default=0)
     owned_game = db.relationship('Game', back_populates='game_master')
     games = db.relationship(
-        'User', secondary=games_and_players,
-        primaryjoin=(games_and_players.c.user_id == id),
-        backref=db.backref('games_and_players', lazy='dynamic')
+        'Game', secondary=games_and_players, back_populates='players', lazy='dynamic'
     )
     team = db.relationship(
         'User', secondary=teammates,
@@ -41,7 +70,7 @@ class User(UserMixin, db.Model):
         return f'<User {self.username}>'
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def set_gm_status(self, status):
         self.gm_status = status
@@ -59,42 +88,121 @@ class User(UserMixin, db.Model):
             return True
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.password_hash)
     
     def my_character(self):
-        own = Character.query.filter_by(user_id=self.id).first_or_404()
-        return own
+        cache = request_cache('my_character')
+        if self.id not in cache:
+            cache[self.id] = Character.query.filter_by(user_id=self.id).first_or_404()
+        return cache[self.id]
     
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        cache = request_cache('avatar')
+        if self.email not in cache:
+            cache[self.email] = md5(self.email.lower().encode('utf-8')).hexdigest()
+        digest = cache[self.email]
         return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
     def join_team(self, user):
         if not self.in_team_with(user):
             self.team.append(user)
+            record_team_change(self, user, True)
 
     def leave_team(self, user):
         if self.in_team_with(user):
             self.team.remove(user)
+            record_team_change(self, user, False)
     
     def in_team_with(self, user):
-        return self.team.filter(teammates.c.teammate_id == user.id).count() > 0
+        return db.session.query(exists().where(
+            (teammates.c.team_member_id == self.id) &
+            (teammates.c.teammate_id == user.id))).scalar()
     
     def interested_players(self, user):
-        return self.team.filter(teammates.c.team_member_id == user.id).count() > 0
+        return db.session.query(exists().where(
+            (teammates.c.team_member_id == user.id) &
+            (teammates.c.teammate_id == self.id))).scalar()
+
+    def teamed_with(self, users):
+        ids = [user.id for user in users]
+        if not ids:
+            return set()
+        rows = db.session.query(teammates.c.teammate_id).filter(
+            teammates.c.team_member_id == self.id,
+            teammates.c.teammate_id.in_(ids))
+        return {teammate_id for teammate_id, in rows}
 
     def team_characters(self):
         team_members = Character.query.join(
             teammates, (teammates.c.teammate_id == Character.user_id)).filter(
                 teammates.c.team_member_id == self.id)
         my_char = Character.query.filter_by(user_id=self.id)
-        return team_members.union(my_char).order_by(Character.name.desc())
+        return team_members.union(my_char).options(
+            joinedload(Character.player)).order_by(Character.name.desc())
     
     def waiting_response(self):
         asks = Character.query.join(
             teammates, (teammates.c.team_member_id == Character.user_id)).filter(
                 teammates.c.teammate_id == self.id)
-        return asks.order_by(Character.name.desc())
+        return asks.options(joinedload(Character.player)).order_by(Character.name.desc())
+
+    def team_view(self):
+        outgoing = db.session.query(
+            teammates.c.teammate_id.label('user_id'),
+            literal(1).label('outgoing'), literal(0).label('incoming')).filter(
+                teammates.c.team_member_id == self.id)
+        incoming = db.session.query(
+            teammates.c.team_member_id.label('user_id'),
+            literal(0).label('outgoing'), literal(1).label('incoming')).filter(
+                teammates.c.teammate_id == self.id)
+        links = outgoing.union_all(incoming).subquery()
+        # Aggregate per user before joining so the eager-loaded player columns
+        # stay out of the GROUP BY, which PostgreSQL would reject.
+        flags = db.session.query(
+            links.c.user_id, func.max(links.c.outgoing).label('outgoing'),
+            func.max(links.c.incoming).label('incoming')).group_by(links.c.user_id).subquery()
+        rows = db.session.query(Character, flags.c.outgoing, flags.c.incoming).join(
+            flags, flags.c.user_id == Character.user_id).options(
+            joinedload(Character.player)).order_by(Character.name.desc())
+        view = TeamView([], [], [])
+        for char, out, inc in rows:
+            if out and inc:
+                view.confirmed.append(char)
+            elif out:
+                view.outgoing.append(char)
+            else:
+                view.incoming.append(char)
+        return view
+
+    def suggested_teammates(self, limit=5):
+        # Links committed by other processes only show up as a newer version.
+        row = CacheVersion.current().get('team')
+        version = row.version if row is not None else 0
+        if not team_graph.is_current(version):
+            team_graph.load(db.session.query(
+                teammates.c.team_member_id, teammates.c.teammate_id), version)
+        ids = team_graph.suggest(self.id, limit)
+        if not ids:
+            return []
+        chars = Character.query.options(joinedload(Character.player)).filter(
+            Character.user_id.in_(ids)).all()
+        return sorted(chars, key=lambda char: ids.index(char.user_id))
+
+def taken_values(checks):
+    """Return the keys of `checks` ({key: (column, value)}) whose value is
+    already stored, using a single query."""
+    probes = [select(literal(key)).where(exists().where(column == value))
+              for key, (column, value) in checks.items()]
+    if not probes:
+        return set()
+    query = probes[0] if len(probes) == 1 else union_all(*probes)
+    return set(db.session.execute(query).scalars())
+
+class GameFull(Exception):
+    pass
 
 class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -103,15 +211,84 @@ class Game(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     game_master = db.relationship('User', back_populates='owned_game')
     system_id = db.Column(db.Integer, db.ForeignKey('system.id'))
+    player_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # player_cap - player_count, or NULL when uncapped; kept in step with
+    # player_count so open games can be found on one column's index.
+    seats_left = db.Column(db.Integer, index=True)
     players = db.relationship(
-        'Game', secondary=games_and_players,
-        secondaryjoin=(games_and_players.c.game_id == id),
-        backref=db.backref('games_and_players', lazy='dynamic')
+        'User', secondary=games_and_players, back_populates='games', lazy='dynamic'
     )
     
     def __repr__(self):
         return f'<Game {self.name}>'
 
+    @validates('player_cap')
+    def update_seats_left(self, key, cap):
+        if cap is None:
+            self.seats_left = None
+        elif inspect(self).persistent:
+            self.seats_left = cap - Game.__table__.c.player_count
+        else:
+            self.seats_left = cap - (self.player_count or 0)
+        return cap
+
+    @staticmethod
+    def has_seats(game):
+        return or_(game.c.seats_left == None, game.c.seats_left > 0)
+
+    def has_player(self, user):
+        return db.session.query(exists().where(
+            (games_and_players.c.game_id == self.id) &
+            (games_and_players.c.user_id == user.id))).scalar()
+
+    def join(self, user):
+        # Take the membership row first so its primary key turns a second,
+        # concurrent join by the same user into a no-op. Then claim the seat
+        # with a conditional UPDATE so concurrent joiners are serialized by the
+        # row lock and the cap is re-checked for each one.
+        member = games_and_players.insert().values(user_id=user.id, game_id=self.id)
+        dialect = db.session.get_bind(Game.__mapper__, member).dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            member = (sqlite if dialect == 'sqlite' else postgresql).insert(
+                games_and_players).values(user_id=user.id, game_id=self.id)
+            if not db.session.execute(member.on_conflict_do_nothing()).rowcount:
+                return False
+        elif self.has_player(user):
+            return False
+        else:
+            db.session.execute(member)
+        game = Game.__table__
+        claimed = db.session.execute(game.update().where(game.c.id == self.id).where(
+            Game.has_seats(game)).values(player_count=game.c.player_count + 1,
+                                         seats_left=game.c.seats_left - 1)).rowcount
+        if not claimed:
+            # Leave the transaction as it was so a caller that catches
+            # GameFull can still commit its other work.
+            db.session.execute(games_and_players.delete().where(
+                (games_and_players.c.game_id == self.id) &
+                (games_and_players.c.user_id == user.id)))
+            raise GameFull(self.name)
+        db.session.expire(self, ['player_count', 'seats_left'])
+        return True
+
+    def leave(self, user):
+        left = db.session.execute(games_and_players.delete().where(
+            (games_and_players.c.game_id == self.id) &
+            (games_and_players.c.user_id == user.id))).rowcount
+        if left:
+            game = Game.__table__
+            db.session.execute(game.update().where(game.c.id == self.id).values(
+                player_count=game.c.player_count - 1, seats_left=game.c.seats_left + 1))
+            db.session.expire(self, ['player_count', 'seats_left'])
+        return bool(left)
+
+    def is_open(self):
+        return self.seats_left is None or self.seats_left > 0
+
+    @staticmethod
+    def open_games():
+        return Game.query.filter(Game.has_seats(Game.__table__)).order_by(Game.name)
+
 class System(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(140), index=True, unique=True)
@@ -120,10 +297,21 @@ class System(db.Model):
     def __repr__(self):
         return f'<System {self.name}>'
 
-inv_weapons = db.Table('inv_weapons',
-    db.Column('w_owner_id', db.Integer, db.ForeignKey('character.id')),
-    db.Column('w_owned_id', db.Integer, db.ForeignKey('weapon.id'))
-)
+class InventoryItem(db.Model):
+    __tablename__ = 'inv_weapons'
+    character_id = db.Column('w_owner_id', db.Integer, db.ForeignKey('character.id'),
+                             primary_key=True)
+    weapon_id = db.Column('w_owned_id', db.Integer, db.ForeignKey('weapon.id'),
+                          primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    character = db.relationship('Character', back_populates='inventory')
+    weapon = db.relationship('Weapon', back_populates='holdings')
+    __table_args__ = (db.Index('ix_inv_weapons_w_owned_id', 'w_owned_id', 'w_owner_id'),)
+
+    def __repr__(self):
+        return f'<InventoryItem {self.character_id} {self.weapon_id} x{self.quantity}>'
+
+inv_weapons = InventoryItem.__table__
 
 class Character(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -138,11 +326,98 @@ class Character(db.Model):
     affiliations = db.Column(db.String(140))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     player = db.relationship('User', back_populates='character')
-    weapons = db.relationship("Weapon", secondary=inv_weapons, back_populates="wielders")
+    carried_weight = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    inventory = db.relationship('InventoryItem', back_populates='character',
+                                cascade='all, delete-orphan', lazy='dynamic')
+    weapons = db.relationship("Weapon", secondary=inv_weapons, back_populates="wielders",
+                              viewonly=True)
 
     def __repr__(self):
         return f'<Character {self.name}>'
 
+    def add_item(self, weapon, quantity=1):
+        # Quantities change in SQL like the totals do, so concurrent adds of
+        # the same weapon keep the inventory and the totals in step.
+        if quantity < 1:
+            raise ValueError(f'Cannot add {quantity} of {weapon.name}; quantity must be at least 1.')
+        db.session.flush()
+        held = inv_weapons.c.quantity + quantity
+        dialect = db.session.get_bind(InventoryItem.__mapper__).dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = (sqlite if dialect == 'sqlite' else postgresql).insert(inv_weapons)
+            db.session.execute(insert.values(w_owner_id=self.id, w_owned_id=weapon.id,
+                                             quantity=quantity).on_conflict_do_update(
+                index_elements=['w_owner_id', 'w_owned_id'], set_={'quantity': held}))
+        elif not db.session.execute(inv_weapons.update().where(
+                self._holding(weapon)).values(quantity=held)).rowcount:
+            db.session.execute(inv_weapons.insert().values(
+                w_owner_id=self.id, w_owned_id=weapon.id, quantity=quantity))
+        self._expire_holding(weapon)
+        self.adjust_totals((weapon.weight or 0) * quantity, quantity)
+
+    def remove_item(self, weapon, quantity=1):
+        # Decrement first so the row is locked, then read back what is left;
+        # a negative remainder means fewer than `quantity` were held.
+        if quantity < 1:
+            raise ValueError(f'Cannot remove {quantity} of {weapon.name}; quantity must be at least 1.')
+        db.session.flush()
+        holding = self._holding(weapon)
+        if not db.session.execute(inv_weapons.update().where(holding).values(
+                quantity=inv_weapons.c.quantity - quantity)).rowcount:
+            return 0
+        left = db.session.execute(select(inv_weapons.c.quantity).where(holding)).scalar()
+        removed = quantity + min(left, 0)
+        if left <= 0:
+            db.session.execute(inv_weapons.delete().where(holding))
+        self._expire_holding(weapon)
+        self.adjust_totals(-(weapon.weight or 0) * removed, -removed)
+        return removed
+
+    def _holding(self, weapon):
+        return (inv_weapons.c.w_owner_id == self.id) & (inv_weapons.c.w_owned_id == weapon.id)
+
+    def _expire_holding(self, weapon):
+        item = db.session.identity_map.get(identity_key(InventoryItem, (self.id, weapon.id)))
+        if item is not None:
+            db.session.expire(item)
+        db.session.expire(self, ['weapons'])
+
+    def adjust_totals(self, weight, count):
+        # Applied in SQL so concurrent changes to the same character add up
+        # instead of overwriting each other's totals.
+        table = Character.__table__
+        db.session.execute(table.update().where(table.c.id == self.id).values(
+            carried_weight=table.c.carried_weight + weight,
+            item_count=table.c.item_count + count))
+        db.session.expire(self, ['carried_weight', 'item_count'])
+        CacheVersion.mark_changed(db.session, 'roster')
+
+    @staticmethod
+    def recount_totals(connection, weapon_ids=None):
+        item, weapon, table = inv_weapons, Weapon.__table__, Character.__table__
+        held_by = item.c.w_owner_id == table.c.id
+        weight = select(func.coalesce(func.sum(
+            item.c.quantity * func.coalesce(weapon.c.weight, 0)), 0)).select_from(
+            item.join(weapon, weapon.c.id == item.c.w_owned_id)).where(held_by).scalar_subquery()
+        count = select(func.coalesce(func.sum(item.c.quantity), 0)).where(
+            held_by).scalar_subquery()
+        stmt = table.update().values(carried_weight=weight, item_count=count)
+        if weapon_ids is not None:
+            stmt = stmt.where(table.c.id.in_(select(item.c.w_owner_id).where(
+                item.c.w_owned_id.in_(weapon_ids))))
+        return connection.execute(stmt).rowcount
+
+    @staticmethod
+    def roster_page(before=None, per_page=25):
+        query = Character.query.options(joinedload(Character.player)).order_by(
+            Character.id.desc())
+        if before is not None:
+            query = query.filter(Character.id < int(before))
+        chars = query.limit(per_page + 1).all()
+        next_cursor = chars[per_page - 1].id if len(chars) > per_page else None
+        return chars[:per_page], next_cursor
+
 class Weapon(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
@@ -153,11 +428,41 @@ class Weapon(db.Model):
     w_type = db.Column(db.String(64))
     a_type = db.Column(db.String(64))
     properties = db.Column(db.String(128))
-    wielders = db.relationship("Character", secondary=inv_weapons, back_populates="weapons")
+    damage_dice = db.Column(db.Integer)
+    damage_sides = db.Column(db.Integer)
+    damage_bonus = db.Column(db.Integer)
+    property_data = db.Column(db.JSON)
+    holdings = db.relationship('InventoryItem', back_populates='weapon', lazy='dynamic')
+    wielders = db.relationship("Character", secondary=inv_weapons, back_populates="weapons",
+                               viewonly=True)
 
     def __repr__(self):
         return f'<Weapon {self.name}>'
 
+    @staticmethod
+    def parsed_columns(damage, properties):
+        dice, sides, bonus = parse_damage(damage) or (None, None, None)
+        return {'damage_dice': dice, 'damage_sides': sides, 'damage_bonus': bonus,
+                'property_data': parse_properties(properties)}
+
+    @validates('damage', 'properties')
+    def parse_on_write(self, key, value):
+        damage = value if key == 'damage' else self.damage
+        properties = value if key == 'properties' else self.properties
+        for column, parsed in Weapon.parsed_columns(damage, properties).items():
+            setattr(self, column, parsed)
+        return value
+
+    def average_damage(self):
+        if self.damage_dice is None:
+            return None
+        return self.damage_dice * (self.damage_sides + 1) / 2 + self.damage_bonus
+
+@event.listens_for(Weapon, 'after_update')
+def update_carried_weight(mapper, connection, target):
+    if inspect(target).attrs.weight.history.has_changes():
+        Character.recount_totals(connection, [target.id])
+
 class Affiliations(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)    
@@ -175,6 +480,143 @@ class Article(db.Model):
     def __repr__(self):
         return f'<Article {self.headline}>'
 
+    def cursor(self):
+        return f'{self.timestamp.strftime(CURSOR_FORMAT)}-{self.id}'
+
+    @staticmethod
+    def parse_cursor(cursor):
+        timestamp, article_id = cursor.split('-')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(article_id)
+
+    @staticmethod
+    def feed_page(before=None, per_page=25):
+        query = Article.query.options(joinedload(Article.author)).order_by(
+            Article.timestamp.desc(), Article.id.desc())
+        if before is not None:
+            timestamp, article_id = Article.parse_cursor(before)
+            # The range on timestamp keeps the scan on the index; the OR only
+            # breaks ties between articles posted in the same microsecond.
+            query = query.filter(Article.timestamp <= timestamp).filter(
+                or_(Article.timestamp < timestamp, Article.id < article_id))
+        articles = query.limit(per_page + 1).all()
+        next_cursor = articles[per_page - 1].cursor() if len(articles) > per_page else None
+        return articles[:per_page], next_cursor
+
+class CacheVersion(db.Model):
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name} {self.version}>'
+
+    @staticmethod
+    def current():
+        cache = request_cache('cache_versions')
+        if not cache:
+            cache.update((row.name, row) for row in CacheVersion.query)
+        return cache
+
+    @staticmethod
+    def bump(session, name):
+        table = CacheVersion.__table__
+        now = datetime.utcnow()
+        result = session.execute(table.update().where(table.c.name == name).values(
+            version=table.c.version + 1, updated=now))
+        if result.rowcount == 0:
+            session.execute(table.insert().values(name=name, version=1, updated=now))
+            return 1
+        return session.execute(select(table.c.version).where(table.c.name == name)).scalar()
+
+    @staticmethod
+    def mark_changed(session, name):
+        session.info.setdefault('cache_versions', set()).add(name)
+
+@event.listens_for(CacheVersion.__table__, 'after_create')
+def seed_cache_versions(target, connection, **kw):
+    connection.execute(target.insert(), [{'name': 'feed', 'version': 0},
+                                         {'name': 'roster', 'version': 0},
+                                         {'name': 'team', 'version': 0},
+                                         {'name': 'users', 'version': 0}])
+
+def roster_changed(session, obj):
+    if isinstance(obj, (Character, InventoryItem)):
+        return True
+    if isinstance(obj, Weapon):
+        return obj not in session.new and inspect(obj).attrs.weight.history.has_changes()
+    if isinstance(obj, User):
+        if obj in session.new or obj in session.deleted:
+            return True
+        state = inspect(obj)
+        return any(state.attrs[key].history.has_changes() for key in ('username', 'email'))
+    return False
+
+@event.listens_for(Session, 'before_flush')
+def collect_cache_changes(session, flush_context, instances):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Article):
+            CacheVersion.mark_changed(session, 'feed')
+        elif roster_changed(session, obj):
+            CacheVersion.mark_changed(session, 'roster')
+
+@event.listens_for(Session, 'before_commit')
+def bump_cache_versions(session):
+    # Bump once per transaction, as late as possible, so the version rows
+    # are only locked while the commit itself runs.
+    session.flush()
+    session.info['bumped_versions'] = {
+        name: CacheVersion.bump(session, name)
+        for name in sorted(session.info.pop('cache_versions', ()))}
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def mark_user_stale(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault('stale_users', set()).add(target.id)
+    CacheVersion.mark_changed(session, 'users')
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_stale_users(session):
+    stale = session.info.pop('stale_users', ())
+    if stale:
+        user_cache.invalidate(stale, session.info.get('bumped_versions', {}).get('users'))
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_pending_changes(session, previous_transaction):
+    session.info.pop('stale_users', None)
+    session.info.pop('team_changes', None)
+    session.info.pop('cache_versions', None)
+    session.info.pop('bumped_versions', None)
+
+def record_team_change(member, teammate, linked):
+    db.session.info.setdefault('team_changes', []).append((member.id, teammate.id, linked))
+    CacheVersion.mark_changed(db.session, 'team')
+
+@event.listens_for(Session, 'after_commit')
+def apply_team_changes(session):
+    versions = session.info.pop('bumped_versions', {})
+    changes = session.info.pop('team_changes', ())
+    if changes:
+        team_graph.apply(changes, versions.get('team'))
+
+def users_version():
+    row = CacheVersion.current().get('users')
+    return row.version if row is not None else 0
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
\ No newline at end of file
+    # Users changed by other processes only show up as a newer version, so
+    # read it alongside the row and check it again before trusting a hit.
+    fields = user_cache.get(int(id), users_version)
+    if fields is None:
+        row = db.session.query(User, CacheVersion.version).outerjoin(
+            CacheVersion, CacheVersion.name == 'users').filter(User.id == int(id)).first()
+        if row is None:
+            return None
+        user, version = row
+        user_cache.set(user.id, {column.key: getattr(user, column.key)
+                                 for column in User.__table__.columns}, version or 0)
+        return user
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from flask import current_app, render_template, request
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+from app.models import CacheVersion
+
+
+class FragmentCache(object):
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, html):
+        with self.lock:
+            self.entries[key] = (version, html)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+def init_app(app):
+    app.extensions['fragment_cache'] = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+    app.add_template_global(cached_fragment)
+
+
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'])
+
+
+def version_of(name):
+    row = CacheVersion.current().get(name)
+    return (row.version, row.updated) if row is not None else (0, None)
+
+
+def cached_fragment(template, name, obj):
+    version = version_of('roster')[0]
+    key = (template, obj.id)
+    html = fragment_cache.get(key, version)
+    if html is None:
+        html = render_template(template, **{name: obj})
+        fragment_cache.set(key, version, html)
+    return Markup(html)
+
+
+def page_validators(*parts):
+    feed, feed_updated = version_of('feed')
+    roster, roster_updated = version_of('roster')
+    key = repr((feed, roster) + parts).encode('utf-8')
+    updated = [stamp for stamp in (feed_updated, roster_updated) if stamp is not None]
+    return md5(key).hexdigest(), max(updated) if updated else None
+
+
+def not_modified(etag, last_modified):
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def make_conditional(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,88 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.local import LocalProxy
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, \
+    check_password_hash
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def parse_method(method):
+    # werkzeug fills in the hash name and iteration count when they are left
+    # out, so 'pbkdf2:sha256' and 'pbkdf2:sha256:260000' are the same method.
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return tuple(parts)
+    hash_name = parts[1] if len(parts) > 1 else 'sha256'
+    iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    return ('pbkdf2', hash_name, iterations)
+
+
+class PasswordHasher(object):
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=1,
+                 max_pending=32, queue_timeout=2):
+        self.configure(method, salt_length, workers, max_pending, queue_timeout)
+
+    def configure(self, method, salt_length, workers, max_pending, queue_timeout):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+
+    def executor(self):
+        # Worker threads do not survive a fork, so each process starts its own.
+        with self.pool_lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='password')
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def submit(self, func, *args):
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise PasswordPoolBusy()
+        try:
+            future = self.executor().submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self.submit(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self.submit(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        if pwhash.count('$') < 2:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        try:
+            stored = parse_method(method)
+        except ValueError:
+            return True
+        return stored != parse_method(self.method) or len(salt) != self.salt_length
+
+
+def init_app(app):
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_SALT_LENGTH'],
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_MAX_PENDING'],
+        app.config['PASSWORD_HASH_QUEUE_TIMEOUT'])
+
+
+hasher = LocalProxy(lambda: current_app.extensions['password_hasher'])
@@ -1,28 +1,41 @@
 from flask import render_template, flash, redirect, url_for
-from app import app
+from flask import Blueprint
+from flask import current_app
 from app.forms import LoginForm
 from flask_login import current_user, login_user
-from app.models import User, Character, Article
+from app.models import User, Character, Article, Game, GameFull
 from flask_login import logout_user
 from flask_login import login_required
 from flask import request
+from flask import abort
+from flask import jsonify
+from flask import Response
+from flask import make_response
+from flask import session
 from werkzeug.urls import url_parse
+from sqlalchemy.exc import IntegrityError
 from app import db
+from app import instrumentation
+from app import last_seen
+from app.search import search_articles
+from app.feed_stream import event_stream
+from app import page_cache
+from app.user_cache import user_cache
 from app.forms import UserRegistrationForm
-from datetime import datetime
 from app.forms import EditProfileForm
 from app.forms import ArticleForm
 from app.forms import EmptyForm
 
+bp = Blueprint('main', __name__)
 
-@app.before_request
+
+@bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.buffer.touch(current_user)
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 def index():
     form = ArticleForm()
     if form.validate_on_submit():
@@ -30,51 +43,110 @@ def index():
         db.session.add(article)
         db.session.commit()
         flash('Your article is now live.')
-        return redirect(url_for('index'))
-    articles = Article.query.all()
-    chars = Character.query.all()
-    return render_template('index.html', title='Articles', articles=articles, form=form, chars=chars)
+        return redirect(url_for('main.index'))
+    before = request.args.get('before')
+    players_before = request.args.get('players_before')
+    # Pages carrying flashed messages or a CSRF token must always be rendered.
+    conditional = '_flashes' not in session and not (
+        current_user.is_authenticated and current_user.gm_status == 1)
+    if conditional:
+        etag, last_modified = page_cache.page_validators(
+            before, players_before, current_user.get_id())
+        if page_cache.not_modified(etag, last_modified):
+            return page_cache.make_conditional(Response(status=304), etag, last_modified)
+    try:
+        articles, next_before = Article.feed_page(
+            before, current_app.config['ARTICLES_PER_PAGE'])
+        chars, next_players_before = Character.roster_page(
+            players_before, current_app.config['PLAYERS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    older_url = url_for('main.index', before=next_before, players_before=players_before) \
+        if next_before else None
+    more_players_url = url_for('main.index', before=before, players_before=next_players_before) \
+        if next_players_before else None
+    response = make_response(render_template(
+        'index.html', title='Articles', articles=articles, form=form, chars=chars,
+        older_url=older_url, more_players_url=more_players_url))
+    if conditional:
+        page_cache.make_conditional(response, etag, last_modified)
+    return response
+
+@bp.route('/stream')
+def stream():
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(event_stream(last_id, current_app.config['STREAM_KEEPALIVE']),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return redirect(url_for('main.index'))
+    page = request.args.get('page', 1, type=int)
+    results = search_articles(q, page, current_app.config['ARTICLES_PER_PAGE'])
+    next_url = url_for('main.search', q=q, page=results.next_num) if results.has_next else None
+    prev_url = url_for('main.search', q=q, page=results.prev_num) if results.has_prev else None
+    return render_template('search.html', title='Search', q=q, articles=results.items,
+                           total=results.total, next_url=next_url, prev_url=prev_url)
 
-@app.route('/knowledge')
+@bp.route('/knowledge')
 @login_required 
 def knowledge():
     return render_template('knowledge.html', title='Knowledge')
 
-@app.route('/user/<username>')
+@bp.route('/user/<username>')
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    my_team = user.team_characters().all()
-    asks = user.waiting_response().all()
+    team = user.team_view()
+    suggestions = user.suggested_teammates() if user == current_user else []
     form = EmptyForm()
-    return render_template('user.html', user=user, my_team=my_team, form=form, asks=asks)
+    return render_template('user.html', user=user, team=team, form=form,
+                           suggestions=suggestions)
 
-@app.route('/login', methods={'GET', 'POST'})
+@bp.route('/login', methods={'GET', 'POST'})
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))    
+        return redirect(url_for('main.index'))    
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
-            next_page = url_for('index')
+            next_page = url_for('main.index')
         return redirect(next_page)
     return render_template('login.html', title='Sign In', form=form)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/register_user', methods=['GET', 'POST'])
+def commit_form(form):
+    # Another request can claim a name between validation and commit; report
+    # it on the form like any other taken value instead of failing with a 500.
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if form.check_unique():
+            flash('Your changes could not be saved, please try again.')
+        return False
+    return True
+
+@bp.route('/register_user', methods=['GET', 'POST'])
 def register_user():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = UserRegistrationForm()
     if form.validate_on_submit():
         user = User(username=form.username.data, email=form.email.data)
@@ -82,38 +154,37 @@ def register_user():
         db.session.add(user)
         char = Character(name=form.name.data, player=user)
         db.session.add(char)
-        db.session.commit()
-        flash('Congratulations, you are now a registered.')
-        return redirect(url_for('login'))       
+        if commit_form(form):
+            flash('Congratulations, you are now a registered.')
+            return redirect(url_for('main.login'))       
     return render_template('register_user.html', title='User Registration', form=form)
 
-from app.forms import EditProfileForm
-
-@app.route('/edit_profile', methods=['GET', 'POST'])
+@bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
+    char = current_user.my_character()
     form = EditProfileForm(
         current_user.username,
-        current_user.my_character().name,
-        current_user.my_character().level,
-        current_user.my_character().speed,
+        char.name,
+        char.level,
+        char.speed,
         )
     if form.validate_on_submit():
         current_user.username = form.username.data
-        current_user.my_character().name = form.char_name.data
-        current_user.my_character().level = form.char_level.data
-        current_user.my_character().speed = form.char_speed.data
-        db.session.commit()
-        flash('Your changes have been saved.')
-        return redirect(url_for('edit_profile'))
+        char.name = form.char_name.data
+        char.level = form.char_level.data
+        char.speed = form.char_speed.data
+        if commit_form(form):
+            flash('Your changes have been saved.')
+            return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
-        form.char_name.data = current_user.my_character().name
-        form.char_level.data = current_user.my_character().level
-        form.char_speed.data = current_user.my_character().speed
+        form.char_name.data = char.name
+        form.char_level.data = char.level
+        form.char_speed.data = char.speed
     return render_template('edit_profile.html', title='Edit Profile', form=form)
 
-@app.route('/join_user/<username>', methods=['POST'])
+@bp.route('/join_user/<username>', methods=['POST'])
 @login_required
 def join_user(username):
     form = EmptyForm()
@@ -121,18 +192,18 @@ def join_user(username):
         user = User.query.filter_by(username=username).first()
         if user is None:
             flash(f"User {username} not found.")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         if user == current_user:
             flash(f"You cannot team up with yourself.")
-            return redirect(url_for('user', username=username))
+            return redirect(url_for('main.user', username=username))
         current_user.join_team(user)
         db.session.commit()
         flash(f'You have requested to team up with {username}.')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
-@app.route('/leave_user/<username>', methods=['POST'])
+@bp.route('/leave_user/<username>', methods=['POST'])
 @login_required
 def leave_user(username):
     form = EmptyForm()
@@ -140,14 +211,85 @@ def leave_user(username):
         user = User.query.filter_by(username=username).first()
         if user is None:
             flash(f"User {username} not found.")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         if user == current_user:
             flash(f"You cannot leave yourself behind.")
-            return redirect(url_for('user', username=username))
+            return redirect(url_for('main.user', username=username))
         current_user.leave_team(user)
         user.leave_team(current_user)
         db.session.commit()
         flash(f'You have left the team.')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
+
+@bp.route('/games')
+@login_required
+def games():
+    form = EmptyForm()
+    my_games = current_user.games.order_by(Game.name).all()
+    return render_template('games.html', title='Open Games', games=Game.open_games().all(),
+                           my_games=my_games, joined={game.id for game in my_games},
+                           form=form)
+
+@bp.route('/join_game/<name>', methods=['POST'])
+@login_required
+def join_game(name):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        game = Game.query.filter_by(name=name).first()
+        if game is None:
+            flash(f'Game {name} not found.')
+            return redirect(url_for('main.games'))
+        try:
+            joined = game.join(current_user)
+            db.session.commit()
+        except GameFull:
+            db.session.rollback()
+            flash(f'{name} is full.')
+            return redirect(url_for('main.games'))
+        except IntegrityError:
+            # Databases without an upsert report a concurrent duplicate join
+            # through the membership primary key.
+            db.session.rollback()
+            joined = False
+        flash(f'You have joined {name}.' if joined else f'You are already playing in {name}.')
+    return redirect(url_for('main.games'))
+
+@bp.route('/leave_game/<name>', methods=['POST'])
+@login_required
+def leave_game(name):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        game = Game.query.filter_by(name=name).first()
+        if game is None:
+            flash(f'Game {name} not found.')
+            return redirect(url_for('main.games'))
+        game.leave(current_user)
+        db.session.commit()
+        flash(f'You have left {name}.')
+    return redirect(url_for('main.games'))
+
+def require_admin():
+    if current_user.email not in current_app.config['ADMINS']:
+        abort(403)
+
+@bp.route('/admin/instrumentation')
+@login_required
+def instrumentation_report():
+    require_admin()
+    if 'instrumentation' not in current_app.extensions:
+        abort(404)
+    return jsonify(instrumentation.summary())
+
+@bp.route('/admin/caches')
+@login_required
+def cache_report():
+    require_admin()
+    return jsonify(users=user_cache.stats(), fragments=page_cache.fragment_cache.stats())
+
+@bp.route('/admin/pools')
+@login_required
+def pool_report():
+    require_admin()
+    return jsonify(db.pool_stats())
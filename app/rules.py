@@ -0,0 +1,48 @@
+import re
+
+DAMAGE_PATTERN = re.compile(
+    r'^\s*(?:(?P<dice>\d*)\s*d\s*(?P<sides>\d+))?\s*(?:(?P<sign>[+-]?)\s*(?P<bonus>\d+))?\s*$',
+    re.IGNORECASE)
+PROPERTY_PATTERN = re.compile(
+    r'^(?P<name>[^\d()]+?)(?:\s*\((?P<detail>[^)]*)\)|\s+(?P<value>[-+]?\d.*))?$')
+
+
+def parse_damage(damage):
+    """Split '2d6+1' style damage into (dice, sides, bonus); None if unreadable."""
+    if not damage:
+        return None
+    match = DAMAGE_PATTERN.match(damage)
+    if match is None or not (match.group('sides') or match.group('bonus')):
+        return None
+    if match.group('sides') and match.group('bonus') and not match.group('sign'):
+        return None
+    dice = int(match.group('dice') or 1) if match.group('sides') else 0
+    sides = int(match.group('sides') or 0)
+    bonus = int(match.group('bonus') or 0)
+    if match.group('sign') == '-':
+        bonus = -bonus
+    return dice, sides, bonus
+
+
+def parse_properties(properties):
+    """Turn 'Burst 3, Heavy, Ammo (power cell)' into
+    {'burst': 3, 'heavy': True, 'ammo': 'power cell'}."""
+    parsed = {}
+    for part in re.split(r'[,;]', properties or ''):
+        part = part.strip()
+        if not part:
+            continue
+        match = PROPERTY_PATTERN.match(part)
+        if match is None:
+            parsed[part.lower()] = True
+            continue
+        name = match.group('name').strip().lower()
+        value = match.group('value')
+        if value is not None:
+            # Only a lone whole number is a value; '20/60' or '10-20' stay text.
+            parsed[name] = int(value) if re.fullmatch(r'[-+]?\d+', value) else value.strip()
+        elif match.group('detail') is not None:
+            parsed[name] = match.group('detail').strip()
+        else:
+            parsed[name] = True
+    return parsed
@@ -0,0 +1,91 @@
+from sqlalchemy import DDL, column, event, func, literal_column, or_, table, text
+import click
+from flask.cli import with_appcontext
+from app import db
+from sqlalchemy.orm import joinedload
+from app.models import Article
+
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS article_fts USING fts5("
+    "headline, body, content='article', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS article_fts_insert AFTER INSERT ON article BEGIN "
+    "INSERT INTO article_fts(rowid, headline, body) "
+    "VALUES (new.id, new.headline, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS article_fts_delete AFTER DELETE ON article BEGIN "
+    "INSERT INTO article_fts(article_fts, rowid, headline, body) "
+    "VALUES ('delete', old.id, old.headline, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS article_fts_update AFTER UPDATE ON article BEGIN "
+    "INSERT INTO article_fts(article_fts, rowid, headline, body) "
+    "VALUES ('delete', old.id, old.headline, old.body); "
+    "INSERT INTO article_fts(rowid, headline, body) "
+    "VALUES (new.id, new.headline, new.body); END",
+]
+
+article_fts = table('article_fts', column('rowid'))
+
+_fts_enabled = {}
+
+
+def fts5_available(ddl, target, bind, **kw):
+    if bind.dialect.name != 'sqlite':
+        return False
+    try:
+        bind.exec_driver_sql('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)')
+        bind.exec_driver_sql('DROP TABLE temp.fts5_probe')
+    except Exception:
+        return False
+    return True
+
+
+for statement in FTS_DDL:
+    event.listen(Article.__table__, 'after_create',
+                 DDL(statement).execute_if(callable_=fts5_available))
+event.listen(Article.__table__, 'after_drop',
+             DDL('DROP TABLE IF EXISTS article_fts').execute_if(dialect='sqlite'))
+event.listen(Article.__table__, 'after_create',
+             lambda target, bind, **kw: _fts_enabled.clear())
+event.listen(Article.__table__, 'after_drop',
+             lambda target, bind, **kw: _fts_enabled.clear())
+
+
+def fts_enabled():
+    engine = db.session.get_bind()
+    url = str(engine.url)
+    if url not in _fts_enabled:
+        _fts_enabled[url] = engine.dialect.name == 'sqlite' and db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'article_fts'")).first() is not None
+    return _fts_enabled[url]
+
+
+def match_terms(q):
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in q.split())
+
+
+def search_articles(q, page=1, per_page=25):
+    if fts_enabled():
+        fts = literal_column('article_fts')
+        query = Article.query.join(
+            article_fts, article_fts.c.rowid == Article.id).filter(
+            fts.op('MATCH')(match_terms(q))).order_by(func.bm25(fts), Article.id.desc())
+    else:
+        query = Article.query.order_by(Article.timestamp.desc(), Article.id.desc())
+        for term in q.split():
+            pattern = f'%{term}%'
+            query = query.filter(or_(
+                Article.headline.ilike(pattern), Article.body.ilike(pattern)))
+    return query.options(joinedload(Article.author)).paginate(page=page, per_page=per_page, error_out=False)
+
+
+@click.command('rebuild-search')
+@with_appcontext
+def rebuild_search():
+    """Create the article search index if needed and refill it."""
+    with db.engine.begin() as conn:
+        if not fts5_available(None, None, conn):
+            click.echo('Full-text search needs SQLite with FTS5; using LIKE fallback.', err=True)
+            return
+        for statement in FTS_DDL:
+            conn.exec_driver_sql(statement)
+        conn.exec_driver_sql("INSERT INTO article_fts(article_fts) VALUES ('rebuild')")
+    _fts_enabled.clear()
+    click.echo('Article search index rebuilt.')
@@ -0,0 +1,90 @@
+import heapq
+import threading
+from collections import Counter, defaultdict
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+
+class TeamGraph(object):
+    def __init__(self):
+        self.following = defaultdict(set)
+        self.followers = defaultdict(set)
+        self.loaded = False
+        self.version = None
+        self.lock = threading.Lock()
+
+    def load(self, edges, version=None):
+        following = defaultdict(set)
+        followers = defaultdict(set)
+        for member_id, teammate_id in edges:
+            following[member_id].add(teammate_id)
+            followers[teammate_id].add(member_id)
+        with self.lock:
+            self.following, self.followers = following, followers
+            self.loaded = True
+            self.version = version
+
+    def reset(self):
+        with self.lock:
+            self.following = defaultdict(set)
+            self.followers = defaultdict(set)
+            self.loaded = False
+            self.version = None
+
+    def is_current(self, version):
+        return self.loaded and self.version == version
+
+    def _link(self, member_id, teammate_id, linked):
+        if linked:
+            self.following[member_id].add(teammate_id)
+            self.followers[teammate_id].add(member_id)
+        else:
+            self.following[member_id].discard(teammate_id)
+            self.followers[teammate_id].discard(member_id)
+
+    def add(self, member_id, teammate_id):
+        with self.lock:
+            if self.loaded:
+                self._link(member_id, teammate_id, True)
+
+    def remove(self, member_id, teammate_id):
+        with self.lock:
+            if self.loaded:
+                self._link(member_id, teammate_id, False)
+
+    def apply(self, changes, version):
+        # A commit from this process moves the shared version on by one. If
+        # anything else moved it too, other workers changed links we have not
+        # seen, so drop the graph and let the next suggestion reload it.
+        with self.lock:
+            if not self.loaded:
+                return
+            if self.version is None or version != self.version + 1:
+                self.loaded = False
+                return
+            for member_id, teammate_id, linked in changes:
+                self._link(member_id, teammate_id, linked)
+            self.version = version
+
+    def neighbours(self, user_id):
+        return self.following.get(user_id, set()) | self.followers.get(user_id, set())
+
+    def suggest(self, user_id, limit=5):
+        with self.lock:
+            linked = self.neighbours(user_id)
+            scores = Counter()
+            for neighbour in linked:
+                for candidate in self.neighbours(neighbour):
+                    scores[candidate] += 1
+        scores.pop(user_id, None)
+        for candidate in linked:
+            scores.pop(candidate, None)
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [candidate for candidate, _ in ranked]
+
+
+def init_app(app):
+    app.extensions['team_graph'] = TeamGraph()
+
+
+team_graph = LocalProxy(lambda: current_app.extensions['team_graph'])
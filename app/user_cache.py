@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+
+class UserCache(object):
+    def __init__(self, size=1024, ttl=300, check_interval=1):
+        self.size = size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.version = None
+        self.checked = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, read_version=None):
+        if read_version is not None and user_id in self.entries:
+            self.sync(read_version)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def sync(self, read_version):
+        # Other processes only announce user changes through the shared
+        # version, so look at it at most once per check_interval before
+        # trusting an entry.
+        with self.lock:
+            if self.checked is not None and \
+                    time.monotonic() - self.checked < self.check_interval:
+                return
+        version = read_version()
+        with self.lock:
+            self._observe(version)
+
+    def _observe(self, version):
+        if self.version is None or version > self.version:
+            self.entries.clear()
+            self.version = version
+        self.checked = time.monotonic()
+
+    def set(self, user_id, fields, version):
+        with self.lock:
+            # A row read under an older version may predate an invalidation.
+            if self.version is not None and version < self.version:
+                return
+            self._observe(version)
+            self.entries[user_id] = (time.monotonic(), dict(fields))
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_ids, version=None):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+            if version is None:
+                return
+            # A commit from this process moves the version on by one; any
+            # other jump means another process changed users too.
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+            else:
+                self._observe(version)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = self.checked = None
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def init_app(app):
+    app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_SIZE'],
+                                             app.config['USER_CACHE_TTL'],
+                                             app.config['USER_CACHE_CHECK_INTERVAL'])
+
+
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])
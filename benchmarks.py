@@ -0,0 +1,420 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import create_app, db
+from app import catalog, last_seen, search
+from app.instrumentation import percentile
+from app.models import User, Article, Character, Weapon, load_user, teammates
+from app.user_cache import user_cache
+from app.team_graph import TeamGraph, team_graph
+from app.page_cache import fragment_cache
+from app.passwords import PasswordHasher
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+def timed(func, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def seed_articles(count, body=lambda i: 'body'):
+    u = User(username='bench', email='bench@mynock.sw')
+    db.session.add(u)
+    db.session.commit()
+    start = datetime.utcnow() - timedelta(seconds=count)
+    db.session.execute(Article.__table__.insert(), [
+        {'headline': f'headline {i}', 'body': body(i), 'user_id': u.id,
+         'timestamp': start + timedelta(seconds=i)}
+        for i in range(count)])
+    db.session.commit()
+
+
+def bench_feed(count=100000):
+    per_page = current_app.config['ARTICLES_PER_PAGE']
+    seed_articles(count)
+    ordered = Article.query.order_by(Article.timestamp.desc(), Article.id.desc())
+    print(f'feed: {count} articles, {per_page} per page (median ms)')
+    for label, position in [('first', None), ('middle', count // 2), ('last', count - per_page)]:
+        cursor = ordered.offset(position).first().cursor() if position else None
+        ms = timed(lambda: Article.feed_page(cursor, per_page))
+        print(f'  keyset page {label:<7} {ms:8.2f}')
+    print(f'  Article.query.all()  {timed(lambda: Article.query.all(), repeat=3):8.2f}')
+
+
+def bench_user_loader(repeat=2000):
+    u = User(username='bench', email='bench@mynock.sw')
+    db.session.add(u)
+    db.session.commit()
+    user_id = str(u.id)
+
+    def load():
+        with current_app.test_request_context():
+            load_user(user_id).username
+            db.session.remove()
+
+    print(f'user loader: {repeat} loads (median ms)')
+    user_cache.clear()
+    user_cache.size = 0
+    print(f'  uncached  {timed(load, repeat):8.4f}')
+    user_cache.size = current_app.config['USER_CACHE_SIZE']
+    load()
+    print(f'  cached    {timed(load, repeat):8.4f}  {user_cache.stats()}')
+
+
+def bench_team_suggestions(users=100000, links=10):
+    rng = random.Random(42)
+    edges = [(member, rng.randrange(users)) for member in range(users) for _ in range(links)]
+    graph = TeamGraph()
+    start = time.perf_counter()
+    graph.load(edges)
+    print(f'team suggestions: {users} users, {len(edges)} links')
+    print(f'  load      {(time.perf_counter() - start) * 1000:8.2f} ms')
+    sample = [rng.randrange(users) for _ in range(200)]
+    ms = timed(lambda: [graph.suggest(user_id) for user_id in sample], repeat=5) / len(sample)
+    print(f'  suggest   {ms:8.4f} ms per user (median)')
+    start = time.perf_counter()
+    for member, teammate in edges[:10000]:
+        graph.remove(member, teammate)
+        graph.add(member, teammate)
+    print(f'  update    {(time.perf_counter() - start) * 1000 / 20000:8.4f} ms per change')
+
+
+def bench_search(count=100000):
+    rng = random.Random(42)
+    words = [f'word{i}' for i in range(5000)]
+    seed_articles(count, lambda i: ' '.join(rng.choice(words) for _ in range(20)))
+    per_page = current_app.config['ARTICLES_PER_PAGE']
+    print(f'search: {count} articles (median ms)')
+    for term in ('word42', 'word42 word7'):
+        fts = timed(lambda: search.search_articles(term, per_page=per_page), repeat=10)
+        search._fts_enabled[str(db.engine.url)] = False
+        like = timed(lambda: search.search_articles(term, per_page=per_page), repeat=3)
+        search._fts_enabled.clear()
+        print(f'  {term!r:<16} fts5 {fts:8.2f}   like {like:8.2f}')
+
+
+def bench_password_hashing(iterations=(50000, 150000, 260000, 600000), logins=40):
+    cores = os.cpu_count() or 1
+    print(f'password hashing: {logins} logins per setting, {cores} cores')
+    for rounds in iterations:
+        method = f'pbkdf2:sha256:{rounds}'
+        for workers in sorted({1, cores}):
+            hasher = PasswordHasher(method, 16, workers, logins, 60)
+            pwhash = hasher.hash('tony')
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as clients:
+                list(clients.map(lambda _: hasher.verify(pwhash, 'tony'), range(logins)))
+            rate = logins / (time.perf_counter() - start)
+            print(f'  {method:<22} workers={workers:<3} {rate:8.1f} logins/s  '
+                  f'{rate / workers:8.1f} per core')
+            hasher.pool.shutdown()
+
+
+def bench_startup(repeat=20):
+    cold = []
+    for _ in range(5):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c',
+                        'from app import create_app; from benchmarks import BenchConfig; '
+                        'create_app(BenchConfig)'], check=True)
+        cold.append(time.perf_counter() - start)
+    cold.sort()
+    print('startup: median ms')
+    print(f'  cold process  {cold[len(cold) // 2] * 1000:8.2f}')
+    print(f'  create_app    {timed(lambda: create_app(BenchConfig), repeat):8.2f}')
+
+
+def bench_catalog(count=100000, batch_size=1000):
+    rows = ({'name': f'blaster {i}', 'damage': '3d6', 'range': i % 100, 'weight': 2}
+            for i in range(count))
+    print(f'catalog: {count} weapons, batches of {batch_size}')
+    start = time.perf_counter()
+    catalog.import_rows(Weapon, rows, batch_size)
+    print(f'  insert    {count / (time.perf_counter() - start):10.0f} rows/s')
+    start = time.perf_counter()
+    catalog.import_rows(Weapon, ({'name': f'blaster {i}', 'damage': '4d6'}
+                                 for i in range(count)), batch_size)
+    print(f'  upsert    {count / (time.perf_counter() - start):10.0f} rows/s')
+    start = time.perf_counter()
+    exported = sum(1 for _ in catalog.export_rows(Weapon, batch_size))
+    print(f'  export    {exported / (time.perf_counter() - start):10.0f} rows/s')
+
+
+def bench_registration(users=200, clients=8):
+    # Concurrent writers need a file database; in-memory SQLite shares one
+    # connection between threads.
+    tmp = tempfile.mkdtemp()
+
+    class RegistrationConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        WTF_CSRF_ENABLED = False
+        PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+        DB_POOL_SIZE = clients
+
+    app = create_app(RegistrationConfig)
+    with app.app_context():
+        db.create_all()
+        try:
+            run_registrations(app, users, clients)
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            shutil.rmtree(tmp)
+
+
+def run_registrations(app, users, clients):
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    def register(i):
+        start = time.perf_counter()
+        response = app.test_client().post('/register_user', data={
+            'username': f'user{i % (users // 2)}', 'email': f'user{i}@mynock.sw',
+            'name': f'char{i}', 'password': 'cat', 'password2': 'cat'})
+        return response.status_code, time.perf_counter() - start
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        register(-1)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(register, range(users)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency * 1000 for _, latency in results]
+    codes = [code for code, _ in results]
+    print(f'registration: {users} attempts from {clients} clients, half of them duplicates')
+    print(f'  statements per registration  {len(statements)}')
+    print(f'  registered {codes.count(302)}, rejected {codes.count(200)}, '
+          f'errors {len(codes) - codes.count(302) - codes.count(200)}')
+    print(f'  {users / elapsed:8.1f} attempts/s   median {percentile(latencies, 50):8.2f} ms   '
+          f'p90 {percentile(latencies, 90):8.2f} ms')
+
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000}
+
+
+def insert_chunked(table, rows, size=10000):
+    for start in range(0, len(rows), size):
+        db.session.execute(table.insert(), rows[start:start + size])
+
+
+def generate(users, seed=42, links=5, articles_per_user=2):
+    """Fill the database with a reproducible community of `users` players."""
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    insert_chunked(User.__table__, [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@mynock.sw',
+         'last_seen': start + timedelta(minutes=rng.randrange(100000))}
+        for i in range(1, users + 1)])
+    insert_chunked(Character.__table__, [
+        {'id': i, 'name': f'char{i}', 'user_id': i, 'level': rng.randint(1, 20),
+         'speed': rng.randint(20, 40), 'age': rng.randint(16, 90)}
+        for i in range(1, users + 1)])
+    pairs = set()
+    for member in range(1, users + 1):
+        for teammate in rng.sample(range(1, users + 1), min(links, users)):
+            if teammate != member:
+                pairs.add((member, teammate))
+                if rng.random() < 0.5:
+                    pairs.add((teammate, member))
+    insert_chunked(teammates, [{'team_member_id': member, 'teammate_id': teammate}
+                               for member, teammate in sorted(pairs)])
+    count = users * articles_per_user
+    insert_chunked(Article.__table__, [
+        {'headline': f'headline {i}', 'body': f'body {i}', 'user_id': rng.randint(1, users),
+         'timestamp': start + timedelta(seconds=i)}
+        for i in range(count)])
+    db.session.commit()
+    return {'users': users, 'characters': users, 'team_links': len(pairs), 'articles': count}
+
+
+def measure(func, repeat, warmup=3):
+    for _ in range(warmup):
+        func()
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        func()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    timings = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        gc.enable()
+    return {'median_ms': percentile(timings, 50), 'p90_ms': percentile(timings, 90),
+            'queries': len(statements)}
+
+
+def suite_cases(app, viewer, other):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(viewer.id)
+        sess['_fresh'] = True
+
+    def route(path):
+        def get():
+            response = client.get(path)
+            assert response.status_code == 200, (path, response.status_code)
+        return get
+
+    def model(func):
+        def call():
+            with app.test_request_context():
+                func(db.session.get(User, viewer.id))
+                db.session.remove()
+        return call
+
+    per_page = app.config['ARTICLES_PER_PAGE']
+    return {
+        'route:index': route('/index'),
+        'route:user': route(f'/user/{viewer.username}'),
+        'route:other_user': route(f'/user/{other.username}'),
+        'route:search': route('/search?q=headline'),
+        'route:games': route('/games'),
+        'model:feed_page': model(lambda user: Article.feed_page(None, per_page)),
+        'model:roster_page': model(lambda user: Character.roster_page(None, per_page)),
+        'model:team_characters': model(lambda user: user.team_characters().all()),
+        'model:waiting_response': model(lambda user: user.waiting_response().all()),
+        'model:team_view': model(lambda user: user.team_view()),
+        'model:suggested_teammates': model(lambda user: user.suggested_teammates()),
+        'model:load_user': model(lambda user: load_user(str(user.id))),
+    }
+
+
+def run_suite(app, scale, seed=42, repeat=20):
+    user_cache.clear()
+    team_graph.reset()
+    fragment_cache.clear()
+    dataset = generate(SCALES[scale], seed)
+    busiest = db.session.query(teammates.c.team_member_id).group_by(
+        teammates.c.team_member_id).order_by(
+        db.func.count().desc(), teammates.c.team_member_id).first()[0]
+    viewer, other = db.session.get(User, busiest), db.session.get(User, 1 if busiest != 1 else 2)
+    results = {name: measure(case, repeat)
+               for name, case in suite_cases(app, viewer, other).items()}
+    last_seen.buffer.flush()
+    return {'meta': {'scale': scale, 'seed': seed, 'repeat': repeat, 'dataset': dataset,
+                     'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version},
+            'results': results}
+
+
+def compare(report, baseline, tolerance=0.5, floor_ms=2.0):
+    """Return a description of every case that got slower or chattier."""
+    if report['meta']['scale'] != baseline['meta']['scale']:
+        return [f"baseline is for scale {baseline['meta']['scale']}, "
+                f"not {report['meta']['scale']}"]
+    regressions = []
+    for name, base in sorted(baseline['results'].items()):
+        current = report['results'].get(name)
+        if current is None:
+            regressions.append(f'{name}: missing from this run')
+            continue
+        if current['queries'] > base['queries']:
+            regressions.append(f"{name}: {current['queries']} queries, "
+                               f"baseline {base['queries']}")
+        limit = base['median_ms'] * (1 + tolerance)
+        if current['median_ms'] > limit and current['median_ms'] - base['median_ms'] > floor_ms:
+            regressions.append(f"{name}: median {current['median_ms']:.2f} ms, "
+                               f"baseline {base['median_ms']:.2f} ms (+{tolerance:.0%} allowed)")
+    return regressions
+
+
+def suite_main(app, args):
+    with app.app_context():
+        db.create_all()
+        report = run_suite(app, args.scale, args.seed, args.repeat)
+        db.session.remove()
+        db.drop_all()
+    print(f"suite: scale {args.scale}, seed {args.seed} (median / p90 ms, queries)")
+    for name, result in report['results'].items():
+        print(f"  {name:<28} {result['median_ms']:8.2f} {result['p90_ms']:8.2f} "
+              f"{result['queries']:4d}")
+    for path in filter(None, [args.json, args.save_baseline]):
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline}.')
+    return 0
+
+
+BENCHMARKS = {
+    'feed': bench_feed,
+    'user_loader': bench_user_loader,
+    'team_suggestions': bench_team_suggestions,
+    'search': bench_search,
+    'password_hashing': bench_password_hashing,
+    'startup': bench_startup,
+    'catalog': bench_catalog,
+    'registration': bench_registration,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run ad hoc benchmarks by name, or "suite" for the regression suite.')
+    parser.add_argument('names', nargs='*', choices=sorted(BENCHMARKS) + ['suite'],
+                        metavar='name')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', metavar='PATH', help='write suite results as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='fail on regressions against PATH')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown of the median before failing (0.5 = 50%%)')
+    args = parser.parse_args()
+    app = create_app(BenchConfig)
+    status = 0
+    for name in args.names or BENCHMARKS:
+        if name == 'suite':
+            status |= suite_main(app, args)
+            continue
+        with app.app_context():
+            db.create_all()
+            BENCHMARKS[name]()
+            db.session.remove()
+            db.drop_all()
+    sys.exit(status)
@@ -1,6 +1,8 @@
-from app import app, db
+from app import create_app, db
 from app.models import User, Article, Character
 
+app = create_app()
+
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Article': Article, 'Character': Character}
\ No newline at end of file
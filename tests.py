@@ -1,21 +1,99 @@
 import os
-os.environ['DATABASE_URL'] = 'sqlite://'
-
+import re
+import shutil
+import tempfile
 import unittest
-from app import app, db
-from app.models import User, Character
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, TimeoutError
+import json
+import logging
+import socket
+import threading
+import time
+from app import create_app, db, instrumentation, search
+from app.last_seen import LastSeenBuffer
+from app.models import load_user
+from app.user_cache import user_cache
+from app.team_graph import team_graph
+from app.feed_stream import FeedHub, event_stream, feed_hub
+from app.page_cache import fragment_cache
+from app.log_pipeline import DigestMailHandler, JSONFormatter, attach_queue
+from app.passwords import PasswordHasher, PasswordPoolBusy, hasher
+from werkzeug.security import generate_password_hash
+from app.models import User, Character, Article, teammates
+from app.models import Game, GameFull, System, Weapon, CacheVersion
+from app.rules import parse_damage, parse_properties
+from app.forms import EditProfileForm, UserRegistrationForm
+from app.routes import commit_form
+from app import catalog
+import benchmarks
+from config import Config
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+class QueryCountMixin(object):
+    @staticmethod
+    @contextmanager
+    def count_queries():
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        with self.count_queries() as statements:
+            yield statements
+        self.assertLessEqual(
+            len(statements), limit,
+            f'{len(statements)} statements issued, expected at most {limit}:\n' +
+            '\n'.join(statements))
+
+class AppTestCase(unittest.TestCase):
+    def config(self):
+        return TestConfig
 
-class UserModelCase(unittest.TestCase):
     def setUp(self):
-        self.app_context = app.app_context()
+        self.app = create_app(self.config())
+        self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
+        self.client = self.app.test_client()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        for bind in [None] + list(self.app.config.get('SQLALCHEMY_BINDS') or ()):
+            db.get_engine(self.app, bind).dispose()
         self.app_context.pop()
 
+    def file_db(self, *binds, **settings):
+        """Return a TestConfig backed by SQLite files, for tests that need
+        several connections to share one database."""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        settings['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'app.db')
+        if binds:
+            settings['SQLALCHEMY_BINDS'] = {
+                bind: 'sqlite:///' + os.path.join(tmp, f'{bind}.db') for bind in binds}
+        return type('FileConfig', (TestConfig,), settings)
+
+    def login(self, user):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(user.id)
+            sess['_fresh'] = True
+
+class UserModelCase(AppTestCase):
     def test_password_hashing(self):
         u = User(username='leenik')
         u.set_password('tony')
@@ -49,6 +127,28 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.team.count(), 0)
         self.assertEqual(u2.teammates.count(), 0)
 
+    def test_team_links(self):
+        u1 = User(username='leenik', email='leenik@mynock.sw')
+        u2 = User(username='bacta', email='bacta@mynock.sw')
+        u3 = User(username='tryst', email='tryst@mynock.sw')
+        u4 = User(username='lynn', email='lynn@mynock.sw')
+        db.session.add_all([u1, u2, u3, u4])
+        db.session.commit()
+        self.assertEqual(u1.teamed_with([u2, u3, u4]), set())
+
+        u1.join_team(u2)
+        u1.join_team(u4)
+        u3.join_team(u1)
+        db.session.commit()
+        self.assertEqual(u1.teamed_with([u2, u3, u4]), {u2.id, u4.id})
+        self.assertEqual(u1.teamed_with([]), set())
+        self.assertTrue(u1.interested_players(u3))
+        self.assertFalse(u1.interested_players(u2))
+
+        with self.assertRaises(IntegrityError):
+            db.session.execute(teammates.insert().values(team_member_id=u1.id, teammate_id=u2.id))
+        db.session.rollback()
+
     def test_team_characters(self):
         u1 = User(username='leenik', email='leenik@mynock.sw')
         u2 = User(username='bacta', email='bacta@mynock.sw')
@@ -78,5 +178,1152 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(tm3, [c4, c3])
         self.assertEqual(tm4, [c4])
 
+    def test_feed_pagination(self):
+        u = User(username='leenik', email='leenik@mynock.sw')
+        now = datetime.utcnow()
+        articles = [Article(headline=f'news {i}', body='body', author=u,
+                            timestamp=now + timedelta(seconds=i // 2))
+                    for i in range(7)]
+        db.session.add_all(articles)
+        db.session.commit()
+
+        page1, cursor = Article.feed_page(per_page=3)
+        page2, cursor2 = Article.feed_page(cursor, per_page=3)
+        page3, cursor3 = Article.feed_page(cursor2, per_page=3)
+        self.assertEqual(page1, [articles[6], articles[5], articles[4]])
+        self.assertEqual(page2, [articles[3], articles[2], articles[1]])
+        self.assertEqual(page3, [articles[0]])
+        self.assertIsNone(cursor3)
+
+        db.session.add(Article(headline='late', body='body', author=u,
+                               timestamp=now + timedelta(minutes=5)))
+        db.session.commit()
+        self.assertEqual(Article.feed_page(cursor, per_page=3)[0], page2)
+        self.assertRaises(ValueError, Article.feed_page, 'garbage')
+
+    def test_roster_pagination(self):
+        chars = [Character(name=f'char {i}') for i in range(5)]
+        db.session.add_all(chars)
+        db.session.commit()
+
+        page1, cursor = Character.roster_page(per_page=3)
+        page2, cursor2 = Character.roster_page(cursor, per_page=3)
+        self.assertEqual(page1, [chars[4], chars[3], chars[2]])
+        self.assertEqual(page2, [chars[1], chars[0]])
+        self.assertIsNone(cursor2)
+
+    def test_my_character_cached_until_commit(self):
+        u = User(username='leenik', email='leenik@mynock.sw')
+        c1 = Character(name='johnny', player=u)
+        db.session.add_all([u, c1])
+        db.session.commit()
+
+        with self.app.test_request_context():
+            self.assertIs(u.my_character(), c1)
+            db.session.delete(c1)
+            self.assertIs(u.my_character(), c1)
+            c2 = Character(name='james', player=u)
+            db.session.add(c2)
+            db.session.commit()
+            self.assertIs(u.my_character(), c2)
+
+    def test_user_loader_cache(self):
+        u = User(username='leenik', email='leenik@mynock.sw')
+        db.session.add(u)
+        db.session.commit()
+        user_id = str(u.id)
+        db.session.remove()
+
+        with self.app.test_request_context():
+            self.assertEqual(load_user(user_id).username, 'leenik')
+        db.session.remove()
+        with self.app.test_request_context(), QueryCountMixin.count_queries() as statements:
+            cached = load_user(user_id)
+            self.assertEqual(cached.username, 'leenik')
+            self.assertIs(User.query.filter_by(username='leenik').first(), cached)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(user_cache.stats()['hits'], 1)
+        self.assertEqual(user_cache.stats()['misses'], 1)
+
+        User.query.get(int(user_id)).set_gm_status(1)
+        db.session.commit()
+        db.session.remove()
+        with self.app.test_request_context():
+            self.assertEqual(load_user(user_id).gm_status, 1)
+        self.assertEqual(user_cache.stats()['misses'], 2)
+
+    def test_user_loader_follows_other_processes(self):
+        u = User(username='leenik', email='leenik@mynock.sw')
+        db.session.add(u)
+        db.session.commit()
+        user_id = str(u.id)
+        user_cache.check_interval = 0
+        for _ in range(2):
+            db.session.remove()
+            with self.app.test_request_context():
+                self.assertEqual(load_user(user_id).gm_status, 0)
+        self.assertEqual(user_cache.stats()['hits'], 1)
+
+        with db.engine.begin() as conn:
+            conn.execute(User.__table__.update().values(gm_status=1))
+            CacheVersion.bump(conn, 'users')
+        db.session.remove()
+        with self.app.test_request_context():
+            self.assertEqual(load_user(user_id).gm_status, 1)
+        self.assertEqual(user_cache.stats()['misses'], 2)
+
+    def test_team_view(self):
+        users = [User(username=f'user{i}', email=f'user{i}@mynock.sw') for i in range(5)]
+        chars = [Character(name=f'char{i}', player=u) for i, u in enumerate(users)]
+        db.session.add_all(users + chars)
+        db.session.commit()
+
+        users[0].join_team(users[1])
+        users[1].join_team(users[0])
+        users[0].join_team(users[2])
+        users[3].join_team(users[0])
+        users[4].join_team(users[0])
+        users[4].join_team(users[3])
+        db.session.commit()
+
+        view = users[0].team_view()
+        self.assertEqual(view.confirmed, [chars[1]])
+        self.assertEqual(view.outgoing, [chars[2]])
+        self.assertEqual(view.incoming, [chars[4], chars[3]])
+        self.assertEqual(users[2].team_view().incoming, [chars[0]])
+
+        with QueryCountMixin.count_queries() as statements:
+            users[0].team_view()
+        group_by = re.findall(r'GROUP BY ([\w.]+)(,?)', statements[0])
+        self.assertEqual([(column.split('.')[-1], more) for column, more in group_by],
+                         [('user_id', '')])
+
+    def test_suggested_teammates(self):
+        users = [User(username=f'user{i}', email=f'user{i}@mynock.sw') for i in range(6)]
+        chars = [Character(name=f'char{i}', player=u) for i, u in enumerate(users)]
+        db.session.add_all(users + chars)
+        db.session.commit()
+
+        users[0].join_team(users[1])
+        users[2].join_team(users[0])
+        users[1].join_team(users[3])
+        users[2].join_team(users[3])
+        users[4].join_team(users[1])
+        db.session.commit()
+        self.assertEqual(users[0].suggested_teammates(), [chars[3], chars[4]])
+        self.assertTrue(team_graph.loaded)
+
+        users[5].join_team(users[2])
+        users[0].join_team(users[3])
+        db.session.commit()
+        self.assertEqual(users[0].suggested_teammates(), [chars[4], chars[5]])
+
+        users[0].leave_team(users[1])
+        db.session.rollback()
+        self.assertEqual(users[0].suggested_teammates(limit=1), [chars[4]])
+
+    def test_suggestions_follow_other_processes(self):
+        users = [User(username=f'user{i}', email=f'user{i}@mynock.sw') for i in range(4)]
+        chars = [Character(name=f'char{i}', player=u) for i, u in enumerate(users)]
+        db.session.add_all(users + chars)
+        users[0].join_team(users[1])
+        users[1].join_team(users[2])
+        db.session.commit()
+        self.assertEqual(users[0].suggested_teammates(), [chars[2]])
+
+        users[1].join_team(users[3])
+        db.session.commit()
+        with QueryCountMixin.count_queries() as statements:
+            self.assertEqual(users[0].suggested_teammates(), [chars[2], chars[3]])
+        self.assertFalse([statement for statement in statements if 'teammates' in statement])
+
+        with db.engine.begin() as conn:
+            conn.execute(teammates.insert().values(team_member_id=users[0].id,
+                                                   teammate_id=users[2].id))
+            CacheVersion.bump(conn, 'team')
+        db.session.commit()
+        self.assertEqual(users[0].suggested_teammates(), [chars[3]])
+
+class SearchCase(AppTestCase):
+    def setUp(self):
+        super(SearchCase, self).setUp()
+        u = User(username='leenik', email='leenik@mynock.sw')
+        self.articles = [
+            Article(headline='Mynock sighting', body='A mynock chewed the power cables.', author=u),
+            Article(headline='Market report', body='Bacta prices are stable.', author=u),
+            Article(headline='Mynock mynock', body='Another mynock nest found near the mynock hangar.', author=u),
+        ]
+        db.session.add_all(self.articles)
+        db.session.commit()
+
+    def test_fts_ranked_and_synced(self):
+        self.assertTrue(search.fts_enabled())
+        results = search.search_articles('mynock')
+        self.assertEqual(results.items, [self.articles[2], self.articles[0]])
+        self.assertEqual(search.search_articles('"bacta', per_page=1).total, 1)
+
+        self.articles[1].body = 'Mynock repellent is sold out.'
+        db.session.delete(self.articles[2])
+        db.session.commit()
+        results = search.search_articles('mynock', per_page=1)
+        self.assertEqual(results.total, 2)
+        self.assertTrue(results.has_next)
+        self.assertEqual(search.search_articles('bacta').total, 0)
+
+    def test_rebuild_command(self):
+        result = self.app.test_cli_runner().invoke(args=['rebuild-search'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Article search index rebuilt.', result.output)
+        self.assertEqual(search.search_articles('bacta').total, 1)
+
+    def test_like_fallback(self):
+        search._fts_enabled[str(db.engine.url)] = False
+        results = search.search_articles('bacta')
+        self.assertEqual(results.items, [self.articles[1]])
+
+    def test_search_route(self):
+        self.assertEqual(self.client.get('/search?q=').status_code, 302)
+        response = self.client.get('/search?q=market')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Market report', response.data)
+        self.assertNotIn(b'Mynock sighting', response.data)
+
+class FeedStreamCase(AppTestCase):
+    def setUp(self):
+        super(FeedStreamCase, self).setUp()
+        self.user = User(username='leenik', email='leenik@mynock.sw')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def post(self, headline):
+        article = Article(headline=headline, body='body', author=self.user)
+        db.session.add(article)
+        db.session.commit()
+        return article
+
+    def test_hub_fan_out_and_slow_consumers(self):
+        hub = FeedHub(queue_size=2, replay_size=3)
+        fast, slow = hub.subscribe(), hub.subscribe()
+        for i in range(1, 4):
+            hub.publish({'id': i})
+            self.assertEqual(fast.get(0)['id'], i)
+        self.assertTrue(slow.dropped)
+        self.assertEqual(hub.subscribers, {fast})
+        self.assertEqual([item['id'] for item in hub.replay(1)], [2, 3])
+        hub.publish({'id': 4})
+        self.assertIsNone(hub.replay(0))
+
+    def test_commits_publish_articles(self):
+        subscriber = feed_hub.subscribe()
+        try:
+            article = self.post('Mynock sighting')
+            db.session.add(Article(headline='Rolled back', body='body', author=self.user))
+            db.session.flush()
+            db.session.rollback()
+            item = subscriber.get(0)
+            self.assertEqual(item['id'], article.id)
+            self.assertEqual(item['author'], 'leenik')
+            self.assertIsNone(subscriber.get(0))
+        finally:
+            feed_hub.unsubscribe(subscriber)
+
+    def test_stream_resumes_from_last_event_id(self):
+        first = self.post('first')
+        second = self.post('second')
+        feed_hub.recent.clear()
+        third = self.post('third')
+        response = self.client.get('/stream', headers={'Last-Event-ID': str(first.id)},
+                                   buffered=False)
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b'retry: 3000\n\n')
+        self.assertIn(f'id: {second.id}\n'.encode(), next(chunks))
+        self.assertIn(f'id: {third.id}\n'.encode(), next(chunks))
+        self.post('fourth')
+        self.assertIn(b'"headline": "fourth"', next(chunks))
+        response.close()
+        self.assertEqual(feed_hub.subscribers, set())
+
+    def test_stream_delivers_out_of_order_publishes(self):
+        chunks = event_stream(None, 0.01)
+        self.assertEqual(next(chunks), 'retry: 3000\n\n')
+        for i in (11, 10, 11, 12):
+            feed_hub.publish({'id': i})
+        self.assertIn('id: 11\n', next(chunks))
+        self.assertIn('id: 10\n', next(chunks))
+        self.assertIn('id: 12\n', next(chunks))
+        self.assertEqual(next(chunks), ': keepalive\n\n')
+        chunks.close()
+        self.assertEqual(feed_hub.subscribers, set())
+
+class LastSeenCase(AppTestCase):
+    def setUp(self):
+        super(LastSeenCase, self).setUp()
+        self.users = [User(username=f'user{i}', email=f'user{i}@mynock.sw') for i in range(20)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        User.query.update({User.last_seen: None})
+        db.session.commit()
+
+    def reload(self, user):
+        return db.session.query(User.last_seen).filter_by(id=user.id).scalar()
+
+    def test_resolution_skips_recent_updates(self):
+        buffer = LastSeenBuffer(resolution=60, interval=3600, threshold=1000)
+        now = datetime.utcnow()
+        u = self.users[0]
+        buffer.touch(u, now)
+        buffer.touch(u, now + timedelta(seconds=30))
+        self.assertEqual(buffer.pending, {u.id: now})
+        buffer.touch(u, now + timedelta(seconds=90))
+        self.assertEqual(buffer.pending, {u.id: now + timedelta(seconds=90)})
+
+    def test_resolution_survives_stale_user_rows(self):
+        buffer = LastSeenBuffer(resolution=60, interval=3600, threshold=1000)
+        now = datetime.utcnow()
+        u = self.users[0]
+        buffer.touch(u, now)
+        buffer.flush()
+        self.assertIsNone(u.last_seen)
+        buffer.touch(u, now + timedelta(seconds=30))
+        self.assertEqual(buffer.pending, {})
+        buffer.touch(u, now + timedelta(seconds=90))
+        self.assertEqual(buffer.pending, {u.id: now + timedelta(seconds=90)})
+
+    def test_threshold_flushes_in_bulk(self):
+        buffer = LastSeenBuffer(resolution=0, interval=3600, threshold=5)
+        now = datetime.utcnow()
+        for u in self.users[:4]:
+            buffer.touch(u, now)
+        self.assertIsNone(self.reload(self.users[0]))
+        buffer.touch(self.users[4], now)
+        self.assertEqual(buffer.pending, {})
+        for u in self.users[:5]:
+            self.assertEqual(self.reload(u), now)
+
+    def test_interval_flushes_on_repeat_touches(self):
+        buffer = LastSeenBuffer(resolution=60, interval=3600, threshold=1000)
+        now = datetime.utcnow()
+        u = self.users[0]
+        buffer.touch(u, now)
+        buffer.last_flush -= 3600
+        buffer.touch(u, now + timedelta(seconds=1))
+        self.assertEqual(buffer.pending, {})
+        self.assertEqual(self.reload(u), now)
+
+    def test_concurrent_touches_are_not_lost(self):
+        buffer = LastSeenBuffer(resolution=0, interval=3600, threshold=7)
+        start = datetime.utcnow()
+
+        def worker(offset):
+            with self.app.app_context():
+                for step in range(50):
+                    for u in self.users:
+                        buffer.touch(u, start + timedelta(seconds=step * 10 + offset))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        buffer.flush()
+        latest = start + timedelta(seconds=49 * 10 + 3)
+        for u in self.users:
+            self.assertEqual(self.reload(u), latest)
+
+    def test_flush_never_moves_last_seen_backwards(self):
+        buffer = LastSeenBuffer(resolution=0, interval=3600, threshold=1000)
+        now = datetime.utcnow()
+        u = self.users[0]
+        u.last_seen = now
+        db.session.commit()
+        buffer.pending[u.id] = now - timedelta(minutes=5)
+        buffer.flush()
+        self.assertEqual(self.reload(u), now)
+
+class RouteQueryCase(QueryCountMixin, AppTestCase):
+    def setUp(self):
+        super(RouteQueryCase, self).setUp()
+        users = [User(username=f'user{i}', email=f'user{i}@mynock.sw') for i in range(10)]
+        db.session.add_all(users)
+        db.session.add_all([Character(name=f'char{i}', player=u) for i, u in enumerate(users)])
+        db.session.add_all([Article(headline=f'news {i}', body='body', author=users[i % 10])
+                            for i in range(20)])
+        for u in users[1:]:
+            users[0].join_team(u)
+            u.join_team(users[0])
+        db.session.commit()
+        self.user = users[0]
+
+    def test_index_queries(self):
+        with self.assertMaxQueries(3):
+            response = self.client.get('/index')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'char9', response.data)
+
+    def test_user_queries(self):
+        self.login(self.user)
+        self.client.get('/user/user0')
+        db.session.remove()
+        with self.assertMaxQueries(4):
+            response = self.client.get('/user/user0')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'char9', response.data)
+
+    def test_edit_profile_queries(self):
+        self.login(self.user)
+        db.session.remove()
+        with self.assertMaxQueries(2):
+            response = self.client.get('/edit_profile')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'char0', response.data)
+
+    def test_index_conditional_get(self):
+        response = self.client.get('/index')
+        etag = response.headers['ETag']
+        self.assertIn('private', response.headers['Cache-Control'])
+        with self.assertMaxQueries(1):
+            response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get(
+            '/index?before=' + Article.query.first().cursor(),
+            headers={'If-None-Match': etag}).status_code, 200)
+        db.session.add(Article(headline='breaking', body='body', author=self.user))
+        db.session.commit()
+        response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'breaking', response.data)
+
+    def test_player_fragments_cached(self):
+        self.client.get('/index')
+        self.assertEqual(fragment_cache.stats()['misses'], 10)
+        self.client.get('/index')
+        self.assertEqual(fragment_cache.stats()['hits'], 10)
+
+        char = Character.query.filter_by(name='char3').first()
+        char.name = 'renamed'
+        db.session.commit()
+        response = self.client.get('/index')
+        self.assertIn(b'renamed', response.data)
+        self.assertEqual(fragment_cache.stats()['misses'], 20)
+
+        self.user.last_seen = datetime.utcnow()
+        db.session.commit()
+        self.client.get('/index')
+        self.assertEqual(fragment_cache.stats()['hits'], 20)
+
+class InstrumentationCase(AppTestCase):
+    def setUp(self):
+        super(InstrumentationCase, self).setUp()
+        instrumentation.init_app(self.app)
+        instrumentation.reset()
+        self.admin = User(username='admin', email=self.app.config['ADMINS'][0])
+        self.user = User(username='leenik', email='leenik@mynock.sw')
+        db.session.add_all([self.admin, self.user])
+        db.session.commit()
+
+    def test_records_route_stats(self):
+        self.client.get('/index')
+        self.client.get('/index')
+        report = instrumentation.summary()['main.index']
+        self.assertEqual(report['count'], 2)
+        self.assertEqual(report['sql_count']['p50'], 3)
+        self.assertGreater(report['render_ms']['p99'], 0)
+        self.assertEqual(len(report['slowest_queries']), 3)
+
+    def test_report_is_admin_only(self):
+        self.login(self.user)
+        self.assertEqual(self.client.get('/admin/instrumentation').status_code, 403)
+        self.login(self.admin)
+        response = self.client.get('/admin/instrumentation')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('main.instrumentation_report', response.get_json())
+        self.assertIn('fragments', self.client.get('/admin/caches').get_json())
+
+    def test_logs_slow_requests(self):
+        budget = self.app.config['SLOW_REQUEST_MS']
+        self.app.config['SLOW_REQUEST_MS'] = 0.001
+        try:
+            with self.assertLogs(self.app.logger, 'WARNING') as logs:
+                self.client.get('/index')
+        finally:
+            self.app.config['SLOW_REQUEST_MS'] = budget
+        self.assertIn('Slow request GET /index', logs.output[0])
+
+class PasswordCase(AppTestCase):
+    def test_rehash_on_login(self):
+        u = User(username='leenik', email='leenik@mynock.sw',
+                 password_hash=generate_password_hash('tony', 'pbkdf2:sha256:1000'))
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_needs_rehash())
+
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            response = self.client.post(
+                '/login', data={'username': 'leenik', 'password': 'tony'})
+        finally:
+            self.app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual(response.status_code, 302)
+        u = User.query.filter_by(username='leenik').first()
+        self.assertTrue(u.password_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+        self.assertFalse(u.password_needs_rehash())
+        self.assertTrue(u.check_password('tony'))
+
+    def test_needs_rehash_compares_parameters(self):
+        hasher = PasswordHasher('pbkdf2:sha256', 16)
+        self.assertFalse(hasher.needs_rehash(
+            generate_password_hash('tony', 'pbkdf2:sha256:260000', 16)))
+        self.assertFalse(PasswordHasher('pbkdf2:sha256:260000', 16).needs_rehash(
+            'pbkdf2:sha256$' + 'a' * 16 + '$digest'))
+        self.assertTrue(hasher.needs_rehash(generate_password_hash('tony', 'pbkdf2:sha256', 8)))
+        self.assertTrue(hasher.needs_rehash(
+            generate_password_hash('tony', 'pbkdf2:sha512', 16)))
+        self.assertTrue(hasher.needs_rehash('not a hash'))
+
+    def test_pool_backpressure(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', 8, workers=1, max_pending=0,
+                                queue_timeout=0.01)
+        release = threading.Event()
+        worker = threading.Thread(target=hasher.submit, args=(release.wait,))
+        worker.start()
+        time.sleep(0.05)
+        self.assertRaises(PasswordPoolBusy, hasher.hash, 'tony')
+        release.set()
+        worker.join()
+        self.assertTrue(hasher.verify(hasher.hash('tony'), 'tony'))
+
+class FakeSMTPServer(object):
+    def __init__(self, hang=False):
+        self.hang = hang
+        self.messages = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if self.hang:
+                continue
+            with conn, conn.makefile('rb') as lines:
+                conn.sendall(b'220 fake\r\n')
+                data = None
+                for line in lines:
+                    if data is not None:
+                        if line == b'.\r\n':
+                            self.messages.append(b''.join(data).decode())
+                            data = None
+                            conn.sendall(b'250 ok\r\n')
+                        else:
+                            data.append(line)
+                    elif line.upper().startswith(b'DATA'):
+                        data = []
+                        conn.sendall(b'354 go\r\n')
+                    elif line.upper().startswith(b'QUIT'):
+                        conn.sendall(b'221 bye\r\n')
+                        break
+                    else:
+                        conn.sendall(b'250 ok\r\n')
+
+    def close(self):
+        self.sock.close()
+
+class LogPipelineCase(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger(f'terminal_news.test.{self.id()}')
+        self.logger.propagate = False
+
+    def mail_handler(self, server, **kwargs):
+        handler = DigestMailHandler(('127.0.0.1', server.port), 'no-reply@test',
+                                    ['admin@test'], 'Failure', **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_json_records(self):
+        stream = []
+        handler = logging.Handler()
+        handler.emit = lambda record: stream.append(handler.format(record))
+        handler.setFormatter(JSONFormatter())
+        listener = attach_queue(self.logger, [handler], 100)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed for %s', 'leenik')
+        listener.stop()
+        entry = json.loads(stream[0])
+        self.assertEqual(entry['message'], 'failed for leenik')
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertIn('ValueError: boom', entry['exception'])
+
+    def test_errors_batched_into_digest(self):
+        server = FakeSMTPServer()
+        self.addCleanup(server.close)
+        handler = self.mail_handler(server, interval=60, max_entries=2)
+        listener = attach_queue(self.logger, [handler], 100)
+        for user in ('a', 'b', 'c'):
+            self.logger.error('could not load %s', user)
+        self.logger.error('database locked')
+        self.logger.error('disk full')
+        listener.stop()
+        handler.send_digest()
+        self.assertEqual(len(server.messages), 1)
+        self.assertIn('Subject: Failure (5 errors)', server.messages[0])
+        self.assertIn('[3x] could not load a', server.messages[0])
+        self.assertIn('1 more errors not shown', server.messages[0])
+
+    def test_hanging_mail_server_does_not_block(self):
+        server = FakeSMTPServer(hang=True)
+        self.addCleanup(server.close)
+        handler = self.mail_handler(server, interval=0.01, timeout=1)
+        handler.handleError = lambda record: None
+        listener = attach_queue(self.logger, [handler], 100)
+        self.addCleanup(listener.stop)
+        self.logger.error('first failure')
+        time.sleep(0.1)
+        start = time.perf_counter()
+        for i in range(100):
+            self.logger.error('failure %d', i)
+        self.assertLess(time.perf_counter() - start, 0.05)
+
+class AppFactoryCase(unittest.TestCase):
+    def test_apps_are_isolated(self):
+        first, second = create_app(TestConfig), create_app(TestConfig)
+        with first.app_context():
+            db.create_all()
+            db.session.add(User(username='susan', email='susan@example.com'))
+            db.session.commit()
+            self.assertEqual(User.query.count(), 1)
+            db.session.remove()
+        with second.app_context():
+            db.create_all()
+            self.assertEqual(User.query.count(), 0)
+            db.session.remove()
+
+    def test_caches_are_per_app(self):
+        first, second = create_app(TestConfig), create_app(TestConfig)
+        for app, name in ((first, 'alice'), (second, 'bob')):
+            with app.app_context():
+                db.create_all()
+                u = User(username=name, email=f'{name}@example.com')
+                db.session.add_all([u, Character(name=f'{name}char', player=u)])
+                db.session.commit()
+                db.session.remove()
+        with first.test_request_context():
+            self.assertEqual(load_user('1').username, 'alice')
+            db.session.remove()
+        self.assertIn(b'alicechar', first.test_client().get('/index').data)
+        with second.test_request_context():
+            self.assertEqual(load_user('1').username, 'bob')
+            self.assertEqual(user_cache.stats()['hits'], 0)
+            self.assertIsNot(team_graph._get_current_object(),
+                             first.extensions['team_graph'])
+            db.session.remove()
+        response = second.test_client().get('/index')
+        self.assertIn(b'bobchar', response.data)
+        self.assertNotIn(b'alicechar', response.data)
+
+    def test_hasher_and_instrumentation_are_per_app(self):
+        class FastHashConfig(TestConfig):
+            PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+        first, second = create_app(TestConfig), create_app(FastHashConfig)
+        for app in (first, second):
+            instrumentation.init_app(app)
+        first.test_client().get('/login')
+        with first.app_context():
+            self.assertEqual(list(instrumentation.summary()), ['main.login'])
+        with second.app_context():
+            self.assertEqual(instrumentation.summary(), {})
+            self.assertEqual(hasher.method, 'pbkdf2:sha256:1000')
+            self.assertIsNot(hasher._get_current_object(),
+                             first.extensions['password_hasher'])
+
+    def test_engine_disposed_in_forked_child(self):
+        app = create_app(TestConfig)
+        with app.app_context():
+            pool = db.engine.pool
+        pid = os.fork()
+        if pid == 0:
+            with app.app_context():
+                os._exit(0 if db.engine.pool is not pool else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+class ReplicaRoutingCase(AppTestCase):
+    def config(self):
+        return self.file_db('replica', WTF_CSRF_ENABLED=False, DB_POOL_SIZE=2,
+                            DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=0.1)
+
+    def setUp(self):
+        super(ReplicaRoutingCase, self).setUp()
+        self.replica = db.get_engine(self.app, 'replica')
+        db.Model.metadata.create_all(self.replica)
+        users = [{'id': 1, 'username': 'susan', 'email': 'susan@example.com'},
+                 {'id': 2, 'username': 'ghost', 'email': 'ghost@example.com'}]
+        characters = [{'name': 'char1', 'user_id': 1}, {'name': 'char2', 'user_id': 2}]
+        db.session.execute(User.__table__.insert(), users[:1])
+        db.session.execute(Character.__table__.insert(), characters[:1])
+        self.login(User.query.get(1))
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), users)
+            conn.execute(Character.__table__.insert(), characters)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.client.get('/user/ghost').status_code, 200)
+        self.assertIsNone(User.query.filter_by(username='ghost').first())
+
+    def test_writes_go_to_primary_and_pin_reads(self):
+        response = self.client.post('/index', data={'headline': 'hi', 'body': 'there'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Article.query.count(), 1)
+        with self.replica.connect() as conn:
+            self.assertIsNone(conn.execute(Article.__table__.select()).first())
+        self.assertEqual(self.client.get('/user/ghost').status_code, 404)
+
+    def test_core_writes_pin_reads(self):
+        game = {'name': 'Rebels', 'player_cap': 3}
+        db.session.execute(Game.__table__.insert(), [game])
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(Game.__table__.insert(), [game])
+        response = self.client.post('/join_game/Rebels', follow_redirects=True)
+        self.assertIn(b'You have joined Rebels.', response.data)
+        self.assertIn(b'You are playing in this game.', response.data)
+        with self.client.session_transaction() as sess:
+            self.assertGreater(sess['_db_primary_until'], time.time())
+
+    def test_pool_metrics(self):
+        self.client.get('/user/susan')
+        held = [db.engine.connect() for _ in range(2)]
+        with self.assertRaises(TimeoutError):
+            db.engine.connect()
+        for conn in held:
+            conn.close()
+        stats = db.pool_stats()
+        self.assertEqual(stats['default']['timeouts'], 1)
+        self.assertGreaterEqual(stats['default']['checkouts'], 2)
+        self.assertGreater(stats['default']['checkout_ms']['max'], 0)
+        self.assertGreater(stats['replica']['checkouts'], 0)
+
+class CatalogCase(AppTestCase):
+    def setUp(self):
+        super(CatalogCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_upsert_in_batches(self):
+        rows = [{'name': f'blaster {i}', 'damage': '3d6', 'range': i} for i in range(25)]
+        batches = []
+        done = catalog.import_rows(Weapon, iter(rows), batch_size=10,
+                                   progress=lambda done, elapsed: batches.append(done))
+        self.assertEqual((done, batches), (25, [10, 20, 25]))
+        catalog.import_rows(Weapon, iter([{'name': 'blaster 3', 'damage': '4d6'}]))
+        catalog.import_rows(Weapon, iter([{'name': 'blaster 4', 'damage': '5d6'}]),
+                            on_conflict='skip')
+        self.assertEqual(Weapon.query.count(), 25)
+        self.assertEqual(Weapon.query.filter_by(name='blaster 3').one().damage, '4d6')
+        self.assertEqual(Weapon.query.filter_by(name='blaster 4').one().damage, '3d6')
+
+    def test_games_round_trip_by_name(self):
+        db.session.add(System(name='d20'))
+        db.session.add(User(username='gm', email='gm@example.com'))
+        db.session.commit()
+        path = self.write('games.csv', ['name,player_cap,system,game_master',
+                                        'Rebels,4,d20,gm', 'Solo,,,'])
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['catalog', 'import', 'games', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 2 games', result.output)
+        rebels = Game.query.filter_by(name='Rebels').one()
+        self.assertEqual((rebels.player_cap, rebels.game_master.username), (4, 'gm'))
+        self.assertEqual(rebels.seats_left, 4)
+        out = os.path.join(self.tmp, 'games.jsonl')
+        result = runner.invoke(args=['catalog', 'export', 'games', out])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(out) as fp:
+            self.assertEqual([json.loads(line) for line in fp], [
+                {'name': 'Rebels', 'player_cap': 4, 'system': 'd20', 'game_master': 'gm'},
+                {'name': 'Solo', 'player_cap': None, 'system': None, 'game_master': None}])
+
+    def test_unknown_reference_fails(self):
+        path = self.write('games.jsonl', ['{"name": "Lost", "system": "nope"}'])
+        result = self.app.test_cli_runner().invoke(args=['catalog', 'import', 'games', path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("unknown system 'nope'", result.output)
+        self.assertEqual(Game.query.count(), 0)
+
+    def test_resume_skips_committed_rows(self):
+        path = self.write('systems.jsonl', [json.dumps({'name': f'sys {i}'}) for i in range(5)])
+        with open(path + '.progress', 'w') as fp:
+            fp.write('3')
+        result = self.app.test_cli_runner().invoke(
+            args=['catalog', 'import', 'systems', path, '--resume'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([s.name for s in System.query.order_by(System.id)], ['sys 3', 'sys 4'])
+        self.assertFalse(os.path.exists(path + '.progress'))
+
+class GameCase(AppTestCase):
+    def config(self):
+        return self.file_db(WTF_CSRF_ENABLED=False, DB_POOL_SIZE=20)
+
+    def setUp(self):
+        super(GameCase, self).setUp()
+        self.users = [User(username=f'player{i}', email=f'player{i}@example.com')
+                      for i in range(20)]
+        self.game = Game(name='Rebels', player_cap=5)
+        db.session.add_all(self.users + [self.game])
+        db.session.commit()
+
+    def test_join_and_leave(self):
+        u1, u2 = self.users[:2]
+        self.assertTrue(self.game.join(u1))
+        self.assertFalse(self.game.join(u1))
+        self.game.join(u2)
+        db.session.commit()
+        self.assertEqual(self.game.player_count, 2)
+        self.assertEqual(self.game.players.order_by(User.id).all(), [u1, u2])
+        self.assertEqual(u1.games.all(), [self.game])
+        self.assertTrue(self.game.leave(u1))
+        self.assertFalse(self.game.leave(u1))
+        db.session.commit()
+        self.assertEqual(self.game.player_count, 1)
+        self.assertEqual(u1.games.all(), [])
+
+    def test_cap_and_open_games(self):
+        solo = Game(name='Solo')
+        db.session.add(solo)
+        for u in self.users[:5]:
+            self.game.join(u)
+        db.session.commit()
+        with self.assertRaises(GameFull):
+            self.game.join(self.users[5])
+        db.session.rollback()
+        self.assertEqual(self.game.player_count, 5)
+        self.assertEqual(Game.open_games().all(), [solo])
+        self.game.leave(self.users[0])
+        db.session.commit()
+        self.assertEqual(Game.open_games().all(), [self.game, solo])
+
+    def test_seats_left_follows_cap_and_players(self):
+        for u in self.users[:2]:
+            self.game.join(u)
+        db.session.commit()
+        self.assertEqual(self.game.seats_left, 3)
+        self.game.player_cap = 2
+        db.session.commit()
+        self.assertEqual(self.game.seats_left, 0)
+        self.assertEqual(Game.open_games().all(), [])
+        self.game.player_cap = None
+        db.session.commit()
+        self.assertIsNone(self.game.seats_left)
+        self.assertEqual(Game.open_games().all(), [self.game])
+        query = Game.query.filter(Game.has_seats(Game.__table__)).statement
+        plan = db.session.execute(text('EXPLAIN QUERY PLAN ' + str(query.compile(
+            db.engine, compile_kwargs={'literal_binds': True})))).fetchall()
+        self.assertIn('ix_game_seats_left', ' '.join(row[-1] for row in plan))
+
+    def test_full_game_leaves_no_membership(self):
+        duel = Game(name='Duel', player_cap=1)
+        db.session.add(duel)
+        duel.join(self.users[0])
+        db.session.commit()
+        with self.assertRaises(GameFull):
+            duel.join(self.users[1])
+        db.session.commit()
+        self.assertEqual(duel.players.all(), [self.users[0]])
+        self.assertEqual(duel.player_count, 1)
+
+    def test_concurrent_joins_never_exceed_cap(self):
+        game_id, user_ids = self.game.id, [u.id for u in self.users]
+        db.session.remove()
+        results = []
+        barrier = threading.Barrier(len(user_ids))
+
+        def join(user_id):
+            with self.app.app_context():
+                game, user = Game.query.get(game_id), User.query.get(user_id)
+                barrier.wait()
+                try:
+                    game.join(user)
+                    db.session.commit()
+                    results.append(True)
+                except GameFull:
+                    db.session.rollback()
+                    results.append(False)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=join, args=(user_id,)) for user_id in user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        game = Game.query.get(game_id)
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(results.count(False), 15)
+        self.assertEqual(game.player_count, 5)
+        self.assertEqual(game.players.count(), 5)
+
+    def test_concurrent_joins_by_one_user(self):
+        game_id, user_id = self.game.id, self.users[0].id
+        db.session.remove()
+        results = []
+        barrier = threading.Barrier(8)
+
+        def join():
+            with self.app.app_context():
+                game, user = Game.query.get(game_id), User.query.get(user_id)
+                barrier.wait()
+                try:
+                    results.append(game.join(user))
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=join) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        game = Game.query.get(game_id)
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+        self.assertEqual(game.player_count, 1)
+        self.assertEqual(game.players.count(), 1)
+
+    def test_join_route(self):
+        self.login(self.users[0])
+        response = self.client.post('/join_game/Rebels', follow_redirects=True)
+        self.assertIn(b'You have joined Rebels.', response.data)
+        self.assertIn(b'You are playing in this game.', response.data)
+        self.assertEqual(self.game.player_count, 1)
+
+class InventoryCase(AppTestCase):
+    def config(self):
+        return self.file_db(DB_POOL_SIZE=10)
+
+    def setUp(self):
+        super(InventoryCase, self).setUp()
+        self.char = Character(name='Tryst')
+        self.blaster = Weapon(name='Blaster', damage='3d6+1', weight=2,
+                              properties='Burst 3, Heavy, Ammo (power cell)')
+        self.knife = Weapon(name='Knife', damage='d4', weight=1)
+        db.session.add_all([self.char, self.blaster, self.knife])
+        db.session.commit()
+
+    def roster_version(self):
+        return CacheVersion.query.get('roster').version
+
+    def test_versions_bumped_once_per_commit(self):
+        version = self.roster_version()
+        with QueryCountMixin.count_queries() as statements:
+            for i in range(3):
+                db.session.add(Character(name=f'extra{i}'))
+                db.session.flush()
+        self.assertFalse([statement for statement in statements if 'cache_version' in statement])
+        db.session.commit()
+        self.assertEqual(self.roster_version(), version + 1)
+
+    def test_parsers(self):
+        self.assertEqual(parse_damage('2d6+1'), (2, 6, 1))
+        self.assertEqual(parse_damage('d8 - 2'), (1, 8, -2))
+        self.assertEqual(parse_damage('5'), (0, 0, 5))
+        self.assertIsNone(parse_damage('lots'))
+        self.assertIsNone(parse_damage('1d6 2'))
+        self.assertEqual(parse_properties('Burst 3; Heavy, Ammo (power cell)'),
+                         {'burst': 3, 'heavy': True, 'ammo': 'power cell'})
+        self.assertEqual(parse_properties('Thrown 20/60, Range 10-20, Recoil -1'),
+                         {'thrown': '20/60', 'range': '10-20', 'recoil': -1})
+        self.assertEqual(parse_properties('Two handed, Mk2 scope, Burst3'),
+                         {'two handed': True, 'mk2 scope': True, 'burst3': True})
+        self.assertEqual(parse_properties(None), {})
+
+    def test_weapon_fields_parsed_on_write(self):
+        self.assertEqual((self.blaster.damage_dice, self.blaster.damage_sides,
+                          self.blaster.damage_bonus), (3, 6, 1))
+        self.assertEqual(self.blaster.average_damage(), 11.5)
+        self.assertEqual(self.blaster.property_data,
+                         {'burst': 3, 'heavy': True, 'ammo': 'power cell'})
+        self.blaster.properties = 'Stun'
+        self.blaster.damage = 'special'
+        db.session.commit()
+        self.assertEqual(self.blaster.property_data, {'stun': True})
+        self.assertIsNone(self.blaster.average_damage())
+
+    def test_totals_follow_inventory(self):
+        version = self.roster_version()
+        self.char.add_item(self.blaster, 2)
+        self.char.add_item(self.knife)
+        self.char.add_item(self.blaster)
+        db.session.commit()
+        self.assertEqual((self.char.carried_weight, self.char.item_count), (7, 4))
+        self.assertEqual(self.char.inventory.filter_by(weapon=self.blaster).one().quantity, 3)
+        self.assertEqual(sorted(w.name for w in self.char.weapons), ['Blaster', 'Knife'])
+        self.assertGreater(self.roster_version(), version)
+
+        self.assertEqual(self.char.remove_item(self.blaster, 5), 3)
+        self.assertEqual(self.char.remove_item(self.blaster), 0)
+        db.session.commit()
+        self.assertEqual((self.char.carried_weight, self.char.item_count), (1, 1))
+
+        self.knife.weight = 4
+        db.session.commit()
+        self.assertEqual(self.char.carried_weight, 4)
+
+    def test_quantity_must_be_positive(self):
+        self.char.add_item(self.knife)
+        db.session.commit()
+        for quantity in (0, -2):
+            self.assertRaises(ValueError, self.char.add_item, self.knife, quantity)
+            self.assertRaises(ValueError, self.char.remove_item, self.knife, quantity)
+        db.session.commit()
+        self.assertEqual(self.char.inventory.filter_by(weapon=self.knife).one().quantity, 1)
+        self.assertEqual((self.char.carried_weight, self.char.item_count), (1, 1))
+
+    def test_concurrent_changes_keep_totals_in_step(self):
+        self.char.add_item(self.blaster, 2)
+        db.session.commit()
+        char_id, blaster_id = self.char.id, self.blaster.id
+        db.session.remove()
+        barrier = threading.Barrier(8)
+
+        def change(i):
+            with self.app.app_context():
+                char, blaster = Character.query.get(char_id), Weapon.query.get(blaster_id)
+                barrier.wait()
+                try:
+                    if i % 4 == 3:
+                        char.remove_item(blaster)
+                    else:
+                        char.add_item(blaster, 2)
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=change, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        char = Character.query.get(char_id)
+        self.assertEqual(char.inventory.one().quantity, 12)
+        self.assertEqual((char.item_count, char.carried_weight), (12, 24))
+
+    def test_catalog_import_recounts_carriers(self):
+        self.char.add_item(self.blaster, 2)
+        db.session.commit()
+        version = self.roster_version()
+        catalog.import_rows(Weapon, iter([{'name': 'Blaster', 'damage': '4d6', 'weight': 5}]))
+        db.session.expire_all()
+        self.assertEqual(self.char.carried_weight, 10)
+        self.assertEqual(self.blaster.damage_dice, 4)
+        self.assertGreater(self.roster_version(), version)
+
+class BenchmarkSuiteCase(AppTestCase):
+    def test_generator_is_reproducible(self):
+        dataset = benchmarks.generate(50, seed=7)
+        links = sorted(db.session.query(teammates.c.team_member_id, teammates.c.teammate_id))
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(benchmarks.generate(50, seed=7), dataset)
+        self.assertEqual(sorted(db.session.query(
+            teammates.c.team_member_id, teammates.c.teammate_id)), links)
+        self.assertEqual((User.query.count(), Article.query.count()), (50, 100))
+
+    def test_compare_flags_regressions(self):
+        def report(ms, queries):
+            return {'meta': {'scale': '1k'},
+                    'results': {'route:index': {'median_ms': ms, 'queries': queries}}}
+
+        baseline = report(10.0, 3)
+        self.assertEqual(benchmarks.compare(report(14.0, 3), baseline), [])
+        self.assertEqual(len(benchmarks.compare(report(20.0, 3), baseline)), 1)
+        self.assertIn('4 queries', benchmarks.compare(report(10.0, 4), baseline)[0])
+        self.assertIn('missing', benchmarks.compare({'meta': {'scale': '1k'}, 'results': {}},
+                                                    baseline)[0])
+
+    def test_suite_runs(self):
+        report = benchmarks.run_suite(self.app, '1k', repeat=1)
+        self.assertEqual(report['meta']['dataset']['users'], 1000)
+        self.assertLessEqual(report['results']['route:index']['queries'], 3)
+        self.assertEqual(benchmarks.compare(report, report), [])
+
+class RegistrationCase(QueryCountMixin, AppTestCase):
+    def config(self):
+        return self.file_db(WTF_CSRF_ENABLED=False, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+                            DB_POOL_SIZE=20)
+
+    def setUp(self):
+        super(RegistrationCase, self).setUp()
+        u = User(username='susan', email='susan@example.com')
+        db.session.add_all([u, Character(name='Tryst', player=u)])
+        db.session.commit()
+
+    def registration(self, i, **fields):
+        data = {'username': f'user{i}', 'email': f'user{i}@example.com', 'name': f'char{i}',
+                'password': 'cat', 'password2': 'cat'}
+        data.update(fields)
+        return data
+
+    def test_uniqueness_checked_in_one_query(self):
+        data = self.registration(1, username='susan', name='Tryst')
+        with self.app.test_request_context('/register_user', method='POST', data=data):
+            form = UserRegistrationForm()
+            with self.assertMaxQueries(1):
+                self.assertFalse(form.validate())
+        self.assertEqual(form.username.errors, ['Please use a different username.'])
+        self.assertEqual(form.email.errors, [])
+        self.assertEqual(form.name.errors, ['Please use a different character name.'])
+
+    def test_edit_profile_skips_unchanged_fields(self):
+        data = {'username': 'susan', 'char_name': 'Tryst', 'char_level': 2, 'char_speed': 30}
+        with self.app.test_request_context('/edit_profile', method='POST', data=data):
+            form = EditProfileForm('susan', 'Tryst', 1, 30)
+            with self.assertMaxQueries(0):
+                self.assertTrue(form.validate())
+
+    def test_commit_race_becomes_form_error(self):
+        with self.app.test_request_context('/register_user', method='POST',
+                                           data=self.registration(1)):
+            form = UserRegistrationForm()
+            self.assertTrue(form.validate())
+            with db.engine.begin() as conn:
+                conn.execute(User.__table__.insert().values(username='user1', email='x@y.z'))
+            db.session.add(User(username='user1', email='user1@example.com'))
+            self.assertFalse(commit_form(form))
+        self.assertEqual(form.username.errors, ['Please use a different username.'])
+        self.assertEqual(User.query.filter_by(username='user1').one().email, 'x@y.z')
+
+    def test_concurrent_registrations(self):
+        barrier = threading.Barrier(10)
+        statuses = []
+
+        def register(i):
+            client = self.app.test_client()
+            barrier.wait()
+            response = client.post('/register_user', data=self.registration(
+                i, username='racer'))
+            statuses.append((response.status_code,
+                             b'Please use a different username.' in response.data))
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(statuses), [(200, True)] * 9 + [(302, False)])
+        self.assertEqual(User.query.filter_by(username='racer').count(), 1)
+        self.assertEqual(Character.query.count(), 2)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file